@@ -0,0 +1,354 @@
+from synthetic_chain import ChainGenerator, DEFAULT_MIX, parse_mix
+from stream_client_class import StreamProxyClient
+from filters import matches_any
+
+import subprocess
+import configparser
+import tempfile
+import shutil
+import argparse
+import logging
+import signal
+import socket
+import json
+import time
+import sys
+import os
+
+log = logging.getLogger('Benchmark')
+
+# End-to-end benchmark: runs stream_proxy.py on a synthetic chain (source = synthetic) in a temporary directory and
+# lets client processes receive from it, half of them through stream() and half through callbacks by default. The
+# first warmup blocks are not measured; of the others every client counts the ops it received and their latency
+# since the block was generated. The chain only depends on the seed and the settings, so the ops each client should
+# have received are counted again here, which gives the loss rate.
+SUBS = [['vote'],
+        ['comment'],
+        ['transfer', 'custom_json'],
+        [{'type': 'custom_json', 'id': 'follow'}],
+        [{'account': 'alice'}],
+        list(DEFAULT_MIX)]
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, share: float):
+    """Nearest rank percentile of sorted values, None if there are none."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def process_usage(pid: int):
+    """CPU seconds and resident bytes of a process and its children (workers) from /proc, None if not available."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as file:
+            fields = file.read().rpartition(')')[2].split()
+        with open('/proc/{}/status'.format(pid)) as file:
+            rss = next(int(line.split()[1]) * 1024 for line in file if line.startswith('VmRSS:'))
+    except (OSError, StopIteration, ValueError):
+        return None, None
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid)) as file:
+            children = [int(child) for child in file.read().split()]
+    except OSError:
+        children = []
+    for child in children:
+        child_cpu, child_rss = process_usage(child)
+        cpu += child_cpu or 0
+        rss += child_rss or 0
+    return cpu, rss
+
+
+def counter_total(stats: dict, name: str):
+    return sum(value for series, value in stats['counters'].items() if series.partition('{')[0] == name)
+
+
+def head_blocks(stats: dict):
+    """Head blocks delivered, by the busiest worker if the proxy runs workers."""
+    return max([value for series, value in stats['counters'].items()
+                if series.startswith('proxy_blocks_total{') and 'mode="head"' in series], default=0)
+
+
+def run_client(spec: dict):
+    """Receives until the proxy stops (or SIGTERM), then prints what was received in the measured blocks as JSON."""
+    client = StreamProxyClient(spec['name'], 'head', ('localhost', spec['port']), subs=spec['subs'],
+                               transport=spec['transport'], codec=spec['codec'], log_level='WARNING',
+                               log_level_listen='WARNING', multicast_interface=spec['multicast_interface'])
+    first, last = spec['first_block'], spec['last_block']
+    received = set()
+    latencies = []
+    result = {'name': spec['name'], 'mode': spec['mode'], 'subs': spec['subs'], 'total': 0}
+
+    def receive(tx):
+        now = time.time()
+        result['total'] += 1
+        if first <= tx['block_num'] <= last:
+            received.add((tx['block_num'], tx['trx_num']))
+            latencies.append(now - tx['generated'])
+
+    def report(*_):
+        result.update(received=len(received), latencies=latencies, counters=client.counters,
+                      dispatch=client.dispatch_stats())
+        sys.stdout.write(json.dumps(result))
+        sys.stdout.flush()
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, report)
+    if spec['mode'] == 'stream':
+        for tx in client.stream():
+            receive(tx)
+    else:
+        client.callable_chain_data = receive
+        if spec['workers']:
+            client.set_dispatch(workers=spec['workers'])
+        client.start_listen(join=True)
+    report()
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.port = args.port or free_port()
+        self.generator = ChainGenerator(ops=args.ops, mix=parse_mix(args.mix) if args.mix else None,
+                                        body_size=args.body_size, oversized=args.oversized,
+                                        oversized_size=args.oversized_size, seed=args.seed)
+        self.warmup_blocks = max(1, int(args.warmup / args.interval))
+        self.first_block = self.warmup_blocks + 1
+        self.last_block = self.warmup_blocks + max(1, int(args.duration / args.interval))
+        self.directory = tempfile.mkdtemp(prefix='stream_proxy_benchmark_')
+        self.proxy = None
+        self.clients = []
+        self.stats = StreamProxyClient('benchmark', 'head', ('localhost', self.port), log_level='WARNING')
+        self.stats.myself_send.settimeout(2)
+
+    def write_config(self):
+        config = configparser.ConfigParser()
+        config['BLOCK_SOURCE'] = {'source': 'synthetic',
+                                  'synthetic_interval': str(self.args.interval),
+                                  'synthetic_ops': str(self.args.ops),
+                                  'synthetic_body_size': str(self.args.body_size),
+                                  'synthetic_oversized': str(self.args.oversized),
+                                  'synthetic_oversized_size': str(self.args.oversized_size),
+                                  'synthetic_seed': str(self.args.seed),
+                                  'synthetic_blocks': str(self.last_block)}
+        if self.args.mix:
+            config['BLOCK_SOURCE']['synthetic_mix'] = self.args.mix
+        config['PROXY_SETTINGS'] = {'port': str(self.port)}
+        if self.args.codec == 'pickle':  # the proxy drops pickled commands by default
+            config['PROXY_SETTINGS']['allow_pickle'] = 'true'
+        for setting in self.args.set:
+            key, _, value = setting.partition('=')
+            config['PROXY_SETTINGS'][key.strip()] = value.strip()
+        config['LOGGING'] = {'log_level': 'WARNING', 'logging_level_main': 'WARNING'}
+        with open(os.path.join(self.directory, 'server_config.ini'), 'w') as file:
+            config.write(file)
+
+    def start_proxy(self):
+        self.write_config()
+        with open(os.path.join(self.directory, 'proxy.log'), 'wb') as proxy_log:
+            self.proxy = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                        'stream_proxy.py')],
+                                          cwd=self.directory, stdout=subprocess.DEVNULL, stderr=proxy_log)
+        deadline = time.monotonic() + 30
+        while self.query_stats() is None:
+            if self.proxy.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError('proxy did not start, see {}'.format(os.path.join(self.directory, 'proxy.log')))
+
+    def query_stats(self):
+        return self.stats.get_stats()
+
+    def start_clients(self):
+        subs = json.loads(self.args.subs) if self.args.subs else SUBS
+        modes = self.args.modes.split(',')
+        for number in range(self.args.clients):
+            spec = {'name': 'bench{}'.format(number), 'port': self.port, 'mode': modes[number % len(modes)],
+                    'subs': subs[number % len(subs)], 'transport': self.args.transport, 'codec': self.args.codec,
+                    'multicast_interface': self.args.multicast_interface, 'workers': self.args.workers,
+                    'first_block': self.first_block, 'last_block': self.last_block}
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--client', json.dumps(spec)],
+                                       stdout=subprocess.PIPE)
+            self.clients.append((spec, process))
+
+    def wait_for_block(self, block_num: int, timeout: float):
+        """Stats of the proxy once it delivered block_num, the last ones it sent if that took longer."""
+        deadline = time.monotonic() + timeout
+        stats = None
+        while time.monotonic() < deadline:
+            stats = self.query_stats() or stats
+            if stats and head_blocks(stats) >= block_num:
+                break
+            time.sleep(0.05)
+        return stats
+
+    def expected(self, subs: list):
+        return sum(1 for block_num in range(self.first_block, self.last_block + 1)
+                   for tx in self.generator.ops_of(block_num) if matches_any(subs, tx))
+
+    def collect_clients(self):
+        results = []
+        for spec, process in self.clients:
+            try:
+                output = process.communicate(timeout=self.args.drain)[0]
+            except subprocess.TimeoutExpired:
+                process.terminate()
+                output = process.communicate()[0]
+            try:
+                result = json.loads(output)
+            except ValueError:
+                result = {'name': spec['name'], 'mode': spec['mode'], 'subs': spec['subs'], 'total': 0,
+                          'received': 0, 'latencies': [], 'failed': True}
+            result['expected'] = self.expected(spec['subs'])
+            results.append(result)
+        return results
+
+    def run(self):
+        started = time.monotonic()
+        self.start_proxy()
+        try:
+            self.start_clients()
+            start_stats = self.wait_for_block(self.warmup_blocks, self.args.warmup * 3 + 30)
+            start_time = time.monotonic()
+            start_cpu, _ = process_usage(self.proxy.pid)
+            rss_peak = 0
+            deadline = start_time + (self.last_block - self.warmup_blocks) * self.args.interval * 3 + 30
+            end_stats = start_stats
+            while time.monotonic() < deadline:
+                end_stats = self.query_stats() or end_stats
+                rss_peak = max(rss_peak, process_usage(self.proxy.pid)[1] or 0)
+                if end_stats and head_blocks(end_stats) >= self.last_block:
+                    break
+                time.sleep(0.25)
+            time.sleep(self.args.drain)  # lets the clients receive the last blocks
+            end_stats = self.query_stats() or end_stats
+            end_time = time.monotonic()
+            end_cpu, rss = process_usage(self.proxy.pid)
+            self.stats.stop()
+            results = self.collect_clients()
+        finally:
+            for _, process in self.clients:
+                if process.poll() is None:
+                    process.kill()
+            try:
+                self.proxy.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proxy.kill()
+        shutil.rmtree(self.directory, ignore_errors=True)  # kept with the log of the proxy if it failed
+        return self.report(results, start_stats, end_stats, end_time - start_time, start_cpu, end_cpu,
+                           max(rss_peak, rss or 0), time.monotonic() - started)
+
+    def report(self, results, start_stats, end_stats, elapsed, start_cpu, end_cpu, rss, wall):
+        window = (self.last_block - self.first_block + 1) * self.args.interval
+        received = sum(result['received'] for result in results)
+        expected = sum(result['expected'] for result in results)
+        latencies = sorted(latency for result in results for latency in result['latencies'])
+        datagrams = None
+        if start_stats and end_stats:
+            datagrams = counter_total(end_stats, 'proxy_sent_datagrams_total') \
+                        + counter_total(end_stats, 'proxy_multicast_messages_total') \
+                        - counter_total(start_stats, 'proxy_sent_datagrams_total') \
+                        - counter_total(start_stats, 'proxy_multicast_messages_total')
+        modes = {}
+        for result in results:
+            modes.setdefault(result['mode'], []).append(result)
+        return {'settings': {key: value for key, value in vars(self.args).items() if key not in ('client', 'output',
+                                                                                              'compare')},
+                'blocks': {'first': self.first_block, 'last': self.last_block},
+                'generated_ops': sum(len(self.generator.ops_of(block_num))
+                                     for block_num in range(self.first_block, self.last_block + 1)),
+                'ops_per_second': received / window,
+                'datagrams_per_second': datagrams / elapsed if datagrams is not None and elapsed else None,
+                'latency_p50': percentile(latencies, 0.5),
+                'latency_p99': percentile(latencies, 0.99),
+                'loss_rate': 1 - received / expected if expected else 0,
+                'proxy_cpu_percent': 100 * (end_cpu - start_cpu) / elapsed
+                if start_cpu is not None and end_cpu is not None and elapsed else None,
+                'proxy_rss_bytes': rss or None,
+                'wall_seconds': wall,
+                'modes': {mode: self.summary(mode_results, window) for mode, mode_results in modes.items()},
+                'clients': [{'name': result['name'], 'mode': result['mode'], 'subs': result['subs'],
+                             'received': result['received'], 'expected': result['expected'],
+                             'latency_p50': percentile(sorted(result['latencies']), 0.5),
+                             'latency_p99': percentile(sorted(result['latencies']), 0.99),
+                             'counters': result.get('counters'), 'dispatch': result.get('dispatch'),
+                             'failed': result.get('failed', False)} for result in results]}
+
+    @staticmethod
+    def summary(results, window):
+        received = sum(result['received'] for result in results)
+        expected = sum(result['expected'] for result in results)
+        latencies = sorted(latency for result in results for latency in result['latencies'])
+        return {'clients': len(results), 'ops_per_second': received / window,
+                'latency_p50': percentile(latencies, 0.5), 'latency_p99': percentile(latencies, 0.99),
+                'loss_rate': 1 - received / expected if expected else 0}
+
+
+def compare(result: dict, baseline: dict, tolerance: float):
+    """Regressions of result against a baseline result, as messages."""
+    regressions = []
+    for key in ('ops_per_second', 'datagrams_per_second'):
+        if result.get(key) is not None and baseline.get(key) and result[key] < baseline[key] * (1 - tolerance):
+            regressions.append('{} dropped from {:.1f} to {:.1f}'.format(key, baseline[key], result[key]))
+    for key in ('latency_p50', 'latency_p99', 'proxy_cpu_percent', 'proxy_rss_bytes'):
+        if result.get(key) is not None and baseline.get(key) and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append('{} grew from {:.4g} to {:.4g}'.format(key, baseline[key], result[key]))
+    if result['loss_rate'] > baseline.get('loss_rate', 0) + tolerance / 10:
+        regressions.append('loss_rate grew from {:.4f} to {:.4f}'.format(baseline.get('loss_rate', 0),
+                                                                         result['loss_rate']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark stream_proxy.py end to end on a synthetic chain.')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--modes', default='stream,callback', help='client modes, assigned in turn')
+    parser.add_argument('--subs', default=None, help='JSON list of subscription lists, assigned in turn')
+    parser.add_argument('--transport', default='udp', choices=['udp', 'shm', 'multicast'])
+    parser.add_argument('--multicast-interface', default='0.0.0.0', help='interface multicast clients join on')
+    parser.add_argument('--codec', default='binary', choices=['binary', 'pickle'])
+    parser.add_argument('--workers', type=int, default=0, help='dispatch workers of the callback clients')
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds per block')
+    parser.add_argument('--ops', type=int, default=100, help='ops per block')
+    parser.add_argument('--mix', default=None, help='op mix like vote:50,comment:15,transfer:15,custom_json:20')
+    parser.add_argument('--body-size', type=int, default=500, help='mean comment body size in bytes')
+    parser.add_argument('--oversized', type=float, default=0.01, help='share of oversized comments')
+    parser.add_argument('--oversized-size', type=int, default=100000, help='body size of oversized comments')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of blocks which are not measured')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of blocks which are measured')
+    parser.add_argument('--drain', type=float, default=3, help='seconds to wait for the last ops')
+    parser.add_argument('--port', type=int, default=0, help='proxy port, a free one if 0')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='additional [PROXY_SETTINGS] of the proxy, may be repeated')
+    parser.add_argument('--output', default=None, help='file to write the JSON result to instead of stdout')
+    parser.add_argument('--compare', default=None, help='baseline result, exits with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change counted as a regression')
+    parser.add_argument('--client', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level='WARNING' if args.client else 'INFO',
+                        format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+
+    if args.client:
+        run_client(json.loads(args.client))
+
+    log.info('Running {} clients for {}s of blocks.'.format(args.clients, args.duration))
+    result = Benchmark(args).run()
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+    log.info('{:.0f} ops/s, p99 latency {:.1f} ms, loss rate {:.4f}.'.format(
+        result['ops_per_second'], (result['latency_p99'] or 0) * 1000, result['loss_rate']))
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            log.warning('Regression: {}.'.format(regression))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,465 @@
+from stream_client_class import StreamProxyClient
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import urllib.request
+import itertools
+import argparse
+import hashlib
+import logging
+import pickle
+import threading
+import socket
+import json
+import gzip
+import time
+import os
+
+log = logging.getLogger('StreamProxy_source')
+
+# Block sources yield the head blocks of the chain as dicts:
+# {'block_num': int, 'block_id': str, 'previous': str, 'timestamp': ..., 'irreversible_block_num': int,
+#  'ops': [operation dicts as produced by beem's Blockchain.stream()]}
+# and can fetch a single block again by number through get_block (None if they cannot).
+
+
+def ops_of_block(block, block_num: int):
+    """Flattens the transactions of a raw block into operation dicts like beem's Blockchain.stream()."""
+    ops = []
+    transaction_ids = block.get('transaction_ids', [])
+    for trx_num, trx in enumerate(block.get('transactions', [])):
+        for event in trx.get('operations', []):
+            if isinstance(event, list):
+                op_type, op = event
+                trx_id = ''
+            else:
+                op_type = event['type']
+                if op_type.endswith('_operation'):
+                    op_type = op_type[:-10]
+                op = event['value']
+                trx_id = transaction_ids[trx_num] if trx_num < len(transaction_ids) else ''
+            tx = {'type': op_type}
+            tx.update(op)
+            tx.update({'_id': hashlib.sha1(json.dumps(event, sort_keys=True).encode('utf-8')).hexdigest(),
+                       'timestamp': block.get('timestamp'),
+                       'block_num': block_num,
+                       'trx_num': trx_num,
+                       'trx_id': trx_id})
+            ops.append(tx)
+    return ops
+
+
+class BeemBlockSource:
+    """Live head blocks of STEEM as streamed by beem.
+
+    The last irreversible block number is asked from the node at most every ``irreversible_refresh`` seconds, not for
+    every block. beem's RPC object is not thread-safe: the stream has its own ``Steem`` instance and every other thread
+    calling ``get_block()``, like the backfill workers, gets one of its own.
+    """
+
+    def __init__(self, node: str, irreversible_refresh: float = 3):
+        from beem.steem import Steem
+        from beem.instance import set_shared_steem_instance
+
+        self.node = node
+        self.steem = Steem(node=node)  # only used by blocks()
+        set_shared_steem_instance(self.steem)
+        self.local = threading.local()
+        self.irreversible_refresh = irreversible_refresh
+        self.irreversible = 0
+        self.refreshed = None  # time.monotonic() of the last refresh
+
+    def _steem(self):
+        """The Steem instance of the calling thread."""
+        steem = getattr(self.local, 'steem', None)
+        if steem is None:
+            from beem.steem import Steem
+
+            steem = self.local.steem = Steem(node=self.node)
+        return steem
+
+    def _irreversible(self):
+        now = time.monotonic()
+        if self.refreshed is None or now - self.refreshed >= self.irreversible_refresh:
+            properties = self._steem().get_dynamic_global_properties(use_stored_data=False)
+            self.irreversible = max(self.irreversible, properties['last_irreversible_block_num'])
+            self.refreshed = now
+        return self.irreversible
+
+    def _convert(self, block):
+        return {'block_num': block.block_num,
+                'block_id': block.get('block_id'),
+                'previous': block.get('previous'),
+                'timestamp': block.get('timestamp'),
+                'irreversible_block_num': self._irreversible(),
+                'ops': ops_of_block(block, block.block_num)}
+
+    def blocks(self):
+        from beem.blockchain import Blockchain
+
+        for block in Blockchain(mode='head', steem_instance=self.steem).blocks():
+            yield self._convert(block)
+
+    def get_block(self, block_num: int):
+        from beem.block import Block
+
+        return self._convert(Block(block_num, steem_instance=self._steem()))
+
+
+FAILURE_PENALTY = 30  # seconds a node which failed is ranked behind the others
+
+
+class RpcError(Exception):
+    pass
+
+
+class RpcNode:
+    def __init__(self, url: str):
+        self.url = url
+        self.latency = None  # moving average of the response time in seconds
+        self.head = 0  # head_block_number of its last answer
+        self.irreversible = 0  # last_irreversible_block_num of its last answer
+        self.failed_at = -FAILURE_PENALTY  # time.monotonic() of the last failed call
+
+
+class RpcBlockSource:
+    """Head blocks fetched over JSON-RPC from a list of nodes.
+
+    Nodes are ranked by recent failures, by lag (more than ``max_lag`` blocks behind the highest head) and by average
+    latency. Each block is asked from the best node; if it does not answer within ``hedge_after`` seconds the next one
+    is asked too and the first answer wins, a failed call fails over to the next node right away. Up to ``prefetch``
+    blocks are fetched in parallel, including the one after the head, which is asked for again every
+    ``retry_interval`` seconds until it exists. Heads of all nodes are polled every ``poll_interval`` seconds.
+    """
+
+    def __init__(self, nodes: list, hedge_after: float = 0.5, prefetch: int = 4, max_lag: int = 3,
+                 poll_interval: float = 1, retry_interval: float = 0.2, timeout: float = 5):
+        self.nodes = [RpcNode(url) for url in nodes]
+        self.hedge_after = hedge_after
+        self.prefetch = max(prefetch, 1)
+        self.max_lag = max_lag
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=2 * len(self.nodes) + 2 * self.prefetch)
+        self.ids = itertools.count()
+        self.primary = None
+        self.hedged = 0  # requests sent to a second node because the first one was slow
+
+    def _call(self, node: RpcNode, method: str, params: list):
+        request = urllib.request.Request(node.url, headers={'Content-Type': 'application/json'},
+                                         data=json.dumps({'jsonrpc': '2.0', 'id': next(self.ids), 'method': method,
+                                                          'params': params}).encode())
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                answer = json.loads(response.read())
+            if 'error' in answer:
+                raise RpcError('{} answered {}: {!s}'.format(node.url, method, answer['error']))
+        except Exception:
+            node.failed_at = time.monotonic()
+            raise
+        elapsed = time.monotonic() - start
+        node.latency = elapsed if node.latency is None else 0.8 * node.latency + 0.2 * elapsed
+        return answer.get('result')
+
+    def ranked(self):
+        """Nodes in the order to ask them: working and up to date first, then by latency."""
+        best = max(node.head for node in self.nodes)
+        now = time.monotonic()
+        nodes = sorted(self.nodes, key=lambda node: (now - node.failed_at < FAILURE_PENALTY,
+                                                     best - node.head > self.max_lag,
+                                                     self.timeout if node.latency is None else node.latency))
+        if nodes[0] is not self.primary:
+            if self.primary is not None:
+                log.warning('Switching to node {}.'.format(nodes[0].url))
+            self.primary = nodes[0]
+        return nodes
+
+    def _poll_node(self, node: RpcNode):
+        was_working = time.monotonic() - node.failed_at >= FAILURE_PENALTY
+        try:
+            properties = self._call(node, 'condenser_api.get_dynamic_global_properties', [])
+        except Exception as e:
+            log.log(logging.WARNING if was_working else logging.DEBUG, 'Node {} failed: {!r}'.format(node.url, e))
+            return
+        node.head = properties['head_block_number']
+        node.irreversible = properties['last_irreversible_block_num']
+
+    def poll(self):
+        """Updates head and irreversible block of every node."""
+        wait([self.pool.submit(self._poll_node, node) for node in self.nodes])
+
+    def _fetch(self, block_num: int):
+        """Returns the raw block from the first node answering with it, None if no node has it."""
+        nodes = iter(self.ranked())
+        pending = set()
+
+        def ask(only_ahead: bool):
+            for node in nodes:
+                if not only_ahead or node.head >= block_num:
+                    pending.add(self.pool.submit(self._call, node, 'condenser_api.get_block', [block_num]))
+                    return True
+            return False
+
+        ask(False)
+        while pending:
+            done, pending = wait(pending, timeout=self.hedge_after, return_when=FIRST_COMPLETED)
+            if not done:
+                if ask(False):
+                    self.hedged += 1
+                continue
+            for future in done:
+                try:
+                    block = future.result()
+                except Exception as e:
+                    log.debug('Fetching block {} failed: {!r}'.format(block_num, e))
+                    ask(False)  # fail over
+                    continue
+                if block:
+                    return block
+                ask(True)  # not there yet, only nodes which are known to have it can help
+        return None
+
+    def _convert(self, block, block_num: int):
+        return {'block_num': block_num,
+                'block_id': block.get('block_id'),
+                'previous': block.get('previous'),
+                'timestamp': block.get('timestamp'),
+                'irreversible_block_num': max(node.irreversible for node in self.nodes),
+                'ops': ops_of_block(block, block_num)}
+
+    def blocks(self):
+        self.poll()
+        next_num = max(node.head for node in self.nodes)
+        prefetched = {}  # block_num: future of _fetch
+        polled = None
+        last_poll = time.monotonic()
+        while True:
+            if time.monotonic() - last_poll >= self.poll_interval and (polled is None or polled.done()):
+                polled = self.pool.submit(self.poll)
+                last_poll = time.monotonic()
+            head = max(node.head for node in self.nodes)
+            for block_num in range(next_num, max(head + 1, next_num) + 1):
+                if len(prefetched) >= self.prefetch:
+                    break
+                if block_num not in prefetched:
+                    prefetched[block_num] = self.pool.submit(self._fetch, block_num)
+            block = prefetched.pop(next_num).result()
+            if block is None:
+                if next_num <= head:
+                    log.warning('Block {} is not available on any node, retrying.'.format(next_num))
+                time.sleep(self.retry_interval)
+                continue
+            yield self._convert(block, next_num)
+            next_num += 1
+
+    def get_block(self, block_num: int):
+        block = self._fetch(block_num)
+        return None if block is None else self._convert(block, block_num)
+
+
+class RecordingBlockSource:
+    """Passes through the blocks of another source and dumps them to a file.
+
+    Each record is the pickled tuple (seconds since start of recording, block), the whole file is gzip compressed. The
+    file is opened once, a later blocks() appends to it and continues the time line where the last one stopped.
+    """
+
+    def __init__(self, source, path: str):
+        self.source = source
+        self.path = path
+        self.file = gzip.open(path, 'wb')
+        self.offset = 0  # seconds since start of recording of the last record
+
+    def blocks(self):
+        log.info('Recording blocks to {}.'.format(self.path))
+        start = time.monotonic() - self.offset
+        for block in self.source.blocks():
+            self.offset = time.monotonic() - start
+            pickle.dump((self.offset, block), self.file, protocol=pickle.HIGHEST_PROTOCOL)
+            yield block
+
+    def get_block(self, block_num: int):
+        return self.source.get_block(block_num)
+
+    def set_subs(self, subs: list):
+        if hasattr(self.source, 'set_subs'):
+            self.source.set_subs(subs)
+
+    def close(self):
+        if hasattr(self.source, 'close'):
+            self.source.close()
+        self.file.close()
+
+
+class ReplayBlockSource:
+    """Feeds the blocks of a file written by RecordingBlockSource.
+
+    ``speed`` 1 replays in real time, N replays N times as fast and 0 as fast as possible. A later blocks() continues
+    after the last block it yielded.
+    """
+
+    def __init__(self, path: str, speed: float = 1, loop: bool = False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.last = None  # number of the last block yielded
+
+    def blocks(self):
+        resume = self.last
+        while True:
+            log.info('Replaying {} at speed {!s}.'.format(self.path, self.speed or 'max'))
+            start = None
+            with gzip.open(self.path, 'rb') as file:
+                while True:
+                    try:
+                        offset, block = pickle.load(file)
+                    except EOFError:
+                        break
+                    if resume is not None and block['block_num'] <= resume:
+                        continue
+                    if self.speed:
+                        if start is None:
+                            start = time.monotonic() - offset / self.speed
+                        delay = start + offset / self.speed - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                    self.last = block['block_num']
+                    yield block
+            resume = None
+            if not self.loop:
+                return
+
+    def get_block(self, block_num: int):
+        return None
+
+
+class ProxyBlockSource:
+    """Blocks from another proxy, which this one registers with like a client, to build a tree of proxies.
+
+    The upstream proxy sends the blocks with only the ops matching the union of the subscriptions of this proxy's
+    clients, which the proxy passes to ``set_subs()`` whenever they change. ``get_block()`` asks the upstream proxy for
+    a backfill of the single block and gives up after ``timeout`` seconds without an answer.
+    """
+
+    def __init__(self, address: tuple, name: str, mode: str = 'head', codec: str = 'binary', timeout: float = 10):
+        self.address = address
+        self.name = name
+        self.mode = mode
+        self.codec = codec
+        self.timeout = timeout
+        self.subs = []
+        self.client = None  # StreamProxyClient of the running blocks()
+        self.ids = itertools.count()
+
+    def set_subs(self, subs: list):
+        if subs == self.subs:
+            return
+        self.subs = subs
+        client = self.client
+        if client is not None and client.running:  # also [], once nobody downstream wants anything
+            client.set_subscriptions(list(subs))
+
+    def _client(self, name: str, **kwargs):
+        return StreamProxyClient(name, self.mode, self.address, subs=list(self.subs) or None, codec=self.codec,
+                                 blocks=True, log_level='WARNING', log_level_listen='WARNING', **kwargs)
+
+    def blocks(self):
+        log.info('Streaming {} blocks from the proxy at {}:{}.'.format(self.mode, *self.address))
+        client = self.client = self._client(self.name)
+        stream = client.stream()
+        try:
+            for block in stream:
+                if (client.subs or []) != self.subs:  # changed while the registration was on its way
+                    client.set_subscriptions(list(self.subs))
+                yield block
+        finally:
+            self.client = None
+            stream.close()  # unregisters
+            client.myself_send.close()
+            client.myself_recv.close()
+
+    def close(self):
+        """Ends blocks() waiting for the upstream on an executor thread, which the proxy waits for when it exits."""
+        client = self.client
+        if client is not None:
+            client.myself_send.sendto(client.codec.dumps({'info': 'stop'}),
+                                      ('localhost', client.myself_recv.getsockname()[1]))
+
+    def get_block(self, block_num: int):
+        client = self._client('{}-{}'.format(self.name, next(self.ids)), start_block=block_num, end_block=block_num)
+        stream = client.stream(timeout=self.timeout)
+        try:
+            for block in stream:
+                if block['block_num'] == block_num:
+                    return block
+        finally:
+            stream.close()  # unregisters
+            client.myself_send.close()
+            client.myself_recv.close()
+        return None
+
+
+def source_from_config(config):
+    source_type = config.get('BLOCK_SOURCE', 'source', fallback='beem')
+    if source_type == 'beem':
+        source = BeemBlockSource(config.get('STEEM_SETTINGS', 'node', fallback='https://anyx.io'),
+                                 config.getfloat('BLOCK_SOURCE', 'irreversible_refresh', fallback=3))
+    elif source_type == 'rpc':
+        nodes = config.get('STEEM_SETTINGS', 'nodes', fallback=None) or config.get('STEEM_SETTINGS', 'node',
+                                                                                    fallback='https://anyx.io')
+        source = RpcBlockSource([node.strip() for node in nodes.split(',') if node.strip()],
+                                hedge_after=config.getfloat('BLOCK_SOURCE', 'hedge_after', fallback=0.5),
+                                prefetch=config.getint('BLOCK_SOURCE', 'prefetch', fallback=4),
+                                max_lag=config.getint('BLOCK_SOURCE', 'max_lag', fallback=3),
+                                poll_interval=config.getfloat('BLOCK_SOURCE', 'poll_interval', fallback=1),
+                                timeout=config.getfloat('BLOCK_SOURCE', 'rpc_timeout', fallback=5))
+    elif source_type == 'replay':
+        source = ReplayBlockSource(config.get('BLOCK_SOURCE', 'replay_file'),
+                                   speed=config.getfloat('BLOCK_SOURCE', 'replay_speed', fallback=1),
+                                   loop=config.getboolean('BLOCK_SOURCE', 'replay_loop', fallback=False))
+    elif source_type == 'synthetic':
+        from synthetic_chain import ChainGenerator, SyntheticBlockSource, parse_mix
+        mix = config.get('BLOCK_SOURCE', 'synthetic_mix', fallback=None)
+        generator = ChainGenerator(ops=config.getint('BLOCK_SOURCE', 'synthetic_ops', fallback=20),
+                                   mix=parse_mix(mix) if mix else None,
+                                   body_size=config.getint('BLOCK_SOURCE', 'synthetic_body_size', fallback=500),
+                                   oversized=config.getfloat('BLOCK_SOURCE', 'synthetic_oversized', fallback=0),
+                                   oversized_size=config.getint('BLOCK_SOURCE', 'synthetic_oversized_size',
+                                                                fallback=100000),
+                                   seed=config.getint('BLOCK_SOURCE', 'synthetic_seed', fallback=0))
+        source = SyntheticBlockSource(generator, interval=config.getfloat('BLOCK_SOURCE', 'synthetic_interval',
+                                                                          fallback=3),
+                                      start_block=config.getint('BLOCK_SOURCE', 'synthetic_start', fallback=1),
+                                      count=config.getint('BLOCK_SOURCE', 'synthetic_blocks', fallback=0))
+    elif source_type == 'proxy':
+        host, _, port = config.get('BLOCK_SOURCE', 'upstream', fallback='localhost:8080').rpartition(':')
+        source = ProxyBlockSource((host, int(port)),
+                                  config.get('BLOCK_SOURCE', 'upstream_name',
+                                             fallback='proxy-{}-{}'.format(socket.gethostname(), os.getpid())),
+                                  mode=config.get('BLOCK_SOURCE', 'upstream_mode', fallback='head'),
+                                  codec=config.get('BLOCK_SOURCE', 'upstream_codec', fallback='binary'),
+                                  timeout=config.getfloat('BLOCK_SOURCE', 'upstream_timeout', fallback=10))
+    else:
+        raise ValueError('unknown block source "{}"'.format(source_type))
+
+    if config.get('BLOCK_SOURCE', 'record_file', fallback=None):
+        source = RecordingBlockSource(source, config.get('BLOCK_SOURCE', 'record_file'))
+    return source
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record the live head blocks of STEEM to a file.')
+    parser.add_argument('file', help='file to write')
+    parser.add_argument('--node', default='https://anyx.io')
+    parser.add_argument('--blocks', type=int, default=0, help='stop after this many blocks (0 for no limit)')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+
+    recorder = RecordingBlockSource(BeemBlockSource(args.node), args.file)
+    try:
+        for count, _ in enumerate(recorder.blocks(), start=1):
+            if count == args.blocks:
+                break
+    finally:
+        recorder.close()
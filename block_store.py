@@ -0,0 +1,229 @@
+from array import array
+import threading
+import logging
+import struct
+import pickle
+import mmap
+import os
+
+log = logging.getLogger('StreamProxy_store')
+
+# A store is a directory of segment files, each holding the blocks of a fixed range of segment_blocks block numbers.
+# A segment file is its header followed by records appended in arrival order: record header and pickled block.
+# Putting a block again appends a new record which supersedes the old one, compaction rewrites a segment without the
+# superseded records. Next to each segment an index file keeps the offset of the record of every block number of the
+# range (0 for missing blocks) and the length of the segment file it covers; records behind that length are indexed
+# again by scanning them when the segment is opened, e.g. after a crash.
+SEGMENT = struct.Struct('<8sQI')  # magic, first block number, blocks per segment
+SEGMENT_MAGIC = b'SPSEG001'
+RECORD = struct.Struct('<IQ')  # length of the pickled block, block number
+INDEX = struct.Struct('<8sQI')  # magic, length of the segment file covered, blocks per segment
+INDEX_MAGIC = b'SPIDX001'
+
+
+class Segment:
+    def __init__(self, path: str, first: int, span: int):
+        self.path = path
+        self.first = first
+        self.span = span
+        if not os.path.exists(path):
+            with open(path, 'wb') as file:
+                file.write(SEGMENT.pack(SEGMENT_MAGIC, first, span))
+        self.file = open(path, 'r+b')
+        magic, stored_first, stored_span = SEGMENT.unpack(self.file.read(SEGMENT.size))
+        if magic != SEGMENT_MAGIC or stored_first != first or stored_span != span:
+            raise ValueError('{} is not a segment of blocks {} to {}'.format(path, first, first + span - 1))
+        self.offsets = array('Q', bytes(8 * span))
+        self.size = self._load_index()
+        self.file.truncate(self.size)  # drops a record cut off by a crash
+        self.live = sum(RECORD.size + self._length(offset) for offset in self.offsets if offset)
+        self.file.seek(self.size)
+        self.map = None
+        self.mapped = 0
+
+    def _load_index(self):
+        """Reads the index file and indexes the records behind the part it covers, returns the valid size."""
+        size = SEGMENT.size
+        try:
+            with open(self.path + '.idx', 'rb') as file:
+                magic, covered, span = INDEX.unpack(file.read(INDEX.size))
+                offsets = array('Q')
+                offsets.frombytes(file.read(8 * self.span))
+            if magic == INDEX_MAGIC and span == self.span and len(offsets) == self.span \
+                    and covered <= os.path.getsize(self.path):
+                self.offsets, size = offsets, covered
+        except (OSError, struct.error, ValueError):
+            pass
+        end = os.path.getsize(self.path)
+        self.file.seek(size)
+        while size + RECORD.size <= end:
+            length, block_num = RECORD.unpack(self.file.read(RECORD.size))
+            if size + RECORD.size + length > end or not 0 <= block_num - self.first < self.span:
+                break
+            self.offsets[block_num - self.first] = size
+            size += RECORD.size + length
+            self.file.seek(size)
+        return size
+
+    def _length(self, offset: int):
+        self.file.seek(offset)
+        return RECORD.unpack(self.file.read(RECORD.size))[0]
+
+    def put(self, block_num: int, data: bytes):
+        """Appends a record, returns the size of the record it supersedes (0 if none)."""
+        index = block_num - self.first
+        dead = 0
+        if self.offsets[index]:
+            dead = RECORD.size + self._length(self.offsets[index])
+            self.file.seek(self.size)
+        self.file.write(RECORD.pack(len(data), block_num) + data)
+        self.file.flush()
+        self.offsets[index] = self.size
+        self.size += RECORD.size + len(data)
+        self.live += RECORD.size + len(data) - dead
+        return dead
+
+    def get(self, block_num: int):
+        """Pickled block from the mapping of the segment file, None if the segment does not have it."""
+        offset = self.offsets[block_num - self.first]
+        if not offset:
+            return None
+        if self.mapped < self.size:  # the file grew since it was mapped
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+            self.mapped = self.size
+        length = RECORD.unpack_from(self.map, offset)[0]
+        return self.map[offset + RECORD.size:offset + RECORD.size + length]
+
+    def compact(self):
+        """Rewrites the segment file with only the latest record of each block."""
+        with open(self.path + '.tmp', 'wb') as file:
+            file.write(SEGMENT.pack(SEGMENT_MAGIC, self.first, self.span))
+            offsets = array('Q', bytes(8 * self.span))
+            size = SEGMENT.size
+            for index, offset in enumerate(self.offsets):
+                if offset:
+                    self.file.seek(offset)
+                    length = RECORD.unpack(self.file.read(RECORD.size))[0]
+                    file.write(RECORD.pack(length, self.first + index) + self.file.read(length))
+                    offsets[index] = size
+                    size += RECORD.size + length
+        self.close(write_index=False)
+        os.replace(self.path + '.tmp', self.path)
+        self.offsets, self.size, self.live = offsets, size, size - SEGMENT.size
+        self.write_index()
+        self.file = open(self.path, 'r+b')
+        self.file.seek(self.size)
+
+    def write_index(self):
+        with open(self.path + '.idx.tmp', 'wb') as file:
+            file.write(INDEX.pack(INDEX_MAGIC, self.size, self.span))
+            file.write(self.offsets.tobytes())
+        os.replace(self.path + '.idx.tmp', self.path + '.idx')
+
+    def close(self, write_index=True):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.mapped = 0
+        self.file.close()
+        if write_index:
+            self.write_index()
+
+    def remove(self):
+        self.close(write_index=False)
+        for path in (self.path, self.path + '.idx'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class BlockStore:
+    """Append-only on-disk store of blocks by number, the first place to look for blocks streamed before.
+
+    ``max_bytes`` limits the size of the segment files (0 for no limit), the segments of the oldest blocks are deleted
+    first. A segment is compacted once its superseded records take more than ``compact_ratio`` of it. Blocks are read
+    through a read-only mapping of their segment. The store may be used from several threads.
+    """
+
+    def __init__(self, directory: str, segment_blocks: int = 10000, max_bytes: int = 0, compact_ratio: float = 0.5):
+        self.directory = directory
+        self.segment_blocks = segment_blocks
+        self.max_bytes = max_bytes
+        self.compact_ratio = compact_ratio
+        self.segments = {}  # first block number: Segment
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.compactions = 0
+        self.closed = False
+        os.makedirs(directory, exist_ok=True)
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.startswith('blocks_') and file_name.endswith('.seg'):
+                first = int(file_name[7:-4])
+                self.segments[first] = Segment(os.path.join(directory, file_name), first, segment_blocks)
+        log.info('Opened block store {} with {} blocks in {} segments.'.format(directory, self.block_count(),
+                                                                             len(self.segments)))
+
+    def _segment(self, block_num: int, create: bool):
+        first = block_num - block_num % self.segment_blocks
+        segment = self.segments.get(first)
+        if segment is None and create:
+            segment = self.segments[first] = Segment(os.path.join(self.directory, 'blocks_{:012d}.seg'.format(first)),
+                                                     first, self.segment_blocks)
+        return segment
+
+    def size(self):
+        return sum(segment.size for segment in self.segments.values())
+
+    def block_count(self):
+        return sum(len(segment.offsets) - segment.offsets.count(0) for segment in self.segments.values())
+
+    def put(self, block):
+        block_num = block['block_num']
+        if block_num < 0:
+            return
+        data = pickle.dumps(block, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.closed:  # a late put of a thread of the default executor
+                return
+            segment = self._segment(block_num, True)
+            segment.put(block_num, data)
+            if segment.size - SEGMENT.size - segment.live > self.compact_ratio * (segment.size - SEGMENT.size):
+                segment.compact()
+                self.compactions += 1
+            if self.max_bytes:
+                self._retain(segment)
+
+    def _retain(self, current: Segment):
+        size = self.size()
+        for first in sorted(self.segments):
+            if size <= self.max_bytes or self.segments[first] is current:
+                break
+            segment = self.segments.pop(first)
+            size -= segment.size
+            segment.remove()
+            log.info('Dropped the stored blocks {} to {}.'.format(first, first + self.segment_blocks - 1))
+
+    def has(self, block_num: int):
+        with self.lock:
+            segment = self._segment(block_num, False) if block_num >= 0 else None
+            return segment is not None and segment.offsets[block_num - segment.first] != 0
+
+    def get(self, block_num: int):
+        """The stored block, None if it is not stored."""
+        with self.lock:
+            segment = self._segment(block_num, False) if block_num >= 0 else None
+            data = segment.get(block_num) if segment is not None else None
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(data)
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments = {}
+            self.closed = True
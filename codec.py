@@ -0,0 +1,120 @@
+import struct
+import pickle
+import json
+
+# Every binary message starts with a fixed header: magic, version, kind, mode, sequence number and op type.
+# The body depends on the kind: JSON for commands, info messages and ops, raw bytes for the envelopes.
+MAGIC = b'SP'
+VERSION = 1
+HEADER = struct.Struct('<2sBBBQB')  # magic, version, kind, mode, sequence number, length of the op type
+ITEM = struct.Struct('<I')  # length prefix of the messages in a batch
+FRAGMENT = struct.Struct('<HH')  # index, count
+GROUP = struct.Struct('<H')  # multicast group of the mode
+
+KIND_COMMAND = 0
+KIND_INFO = 1
+KIND_DATA = 2
+KIND_BATCH = 3
+KIND_SEQUENCED = 4
+KIND_FRAGMENT = 5
+KIND_MULTICAST = 6
+MODES = {None: 0, 'head': 1, 'irreversible': 2}
+MODE_NAMES = {number: name for name, number in MODES.items()}
+
+
+class PickleCodec:
+    """The original wire format, every message is a pickled dict (or list of command dicts)."""
+    name = 'pickle'
+
+    @staticmethod
+    def dumps(message, mode: str = None) -> bytes:
+        return pickle.dumps(message)
+
+    @staticmethod
+    def loads(raw: bytes):
+        return pickle.loads(raw)
+
+
+class BinaryCodec:
+    """Compact binary format: fixed header, JSON bodies for commands, info messages and ops.
+
+    Values JSON cannot represent, like the datetime timestamps of beem, are sent as strings, sets as lists.
+    Decoding never executes code, unlike pickle.
+    """
+    name = 'binary'
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, (set, frozenset)):
+            return sorted(value)
+        return str(value)
+
+    def _json(self, value) -> bytes:
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=self._default).encode()
+
+    @staticmethod
+    def _header(kind: int, mode: str = None, seq: int = 0, op_type: str = '') -> bytes:
+        op_type = op_type.encode()
+        return HEADER.pack(MAGIC, VERSION, kind, MODES.get(mode, 0), seq, len(op_type)) + op_type
+
+    def dumps(self, message, mode: str = None) -> bytes:
+        if isinstance(message, list) or 'command' in message:
+            return self._header(KIND_COMMAND) + self._json(message)
+        info = message.get('info')
+        if info == 'stream_data':
+            return self._header(KIND_DATA, mode, 0, message['data'].get('type', '')) + self._json(message['data'])
+        if info == 'stream_batch':
+            return self._header(KIND_BATCH, mode) + b''.join(ITEM.pack(len(item)) + item for item in message['data'])
+        if info == 'sequenced':
+            return self._header(KIND_SEQUENCED, mode, message['seq']) + message['data']
+        if info == 'fragment':
+            return self._header(KIND_FRAGMENT, mode, message['id']) + \
+                FRAGMENT.pack(message['index'], message['count']) + message['data']
+        if info == 'multicast':
+            return self._header(KIND_MULTICAST, message['mode'], message['seq']) + GROUP.pack(message['group']) + \
+                message['data']
+        return self._header(KIND_INFO, mode) + self._json(message)
+
+    @staticmethod
+    def header(raw: bytes):
+        """Returns kind, mode, sequence number and op type of a message and the offset of its body."""
+        magic, version, kind, mode, seq, type_length = HEADER.unpack_from(raw)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a binary message of version {}'.format(VERSION))
+        offset = HEADER.size + type_length
+        return kind, MODE_NAMES.get(mode), seq, bytes(raw[HEADER.size:offset]).decode(), offset
+
+    def loads(self, raw: bytes):
+        kind, mode, seq, op_type, offset = self.header(raw)
+        body = memoryview(raw)[offset:]
+        if kind == KIND_DATA:
+            return {'info': 'stream_data', 'data': json.loads(bytes(body))}
+        if kind == KIND_BATCH:
+            items = []
+            while len(body):
+                length = ITEM.unpack_from(body)[0]
+                items.append(bytes(body[ITEM.size:ITEM.size + length]))
+                body = body[ITEM.size + length:]
+            return {'info': 'stream_batch', 'data': items}
+        if kind == KIND_SEQUENCED:
+            return {'info': 'sequenced', 'seq': seq, 'data': bytes(body)}
+        if kind == KIND_FRAGMENT:
+            index, count = FRAGMENT.unpack_from(body)
+            return {'info': 'fragment', 'id': seq, 'index': index, 'count': count, 'data': bytes(body[FRAGMENT.size:])}
+        if kind == KIND_MULTICAST:
+            return {'info': 'multicast', 'mode': mode, 'group': GROUP.unpack_from(body)[0], 'seq': seq,
+                    'data': bytes(body[GROUP.size:])}
+        return json.loads(bytes(body))
+
+
+CODECS = {'pickle': PickleCodec(), 'binary': BinaryCodec()}
+DEFAULT_CODEC = 'binary'
+
+
+def codec_of(raw: bytes):
+    """Tells the codec of a received message by its first bytes, pickle protocol 2+ starts with 0x80."""
+    return CODECS['binary'] if raw[:2] == MAGIC else CODECS['pickle']
+
+
+def loads(raw: bytes):
+    return codec_of(raw).loads(raw)
@@ -0,0 +1,95 @@
+import threading
+import logging
+import queue
+
+log = logging.getLogger('StreamProxyClient_dispatch')
+
+
+class Dispatcher:
+    """Runs the callbacks of received ops on worker threads, so a slow callback does not hold up receiving.
+
+    ``put()`` never blocks, an op finding its queue full is dropped and counted. Without ``key`` the workers share one
+    queue and ops may be handled out of order. With ``key`` (an op field or a function of the op) the ops of a key
+    always go to the same worker and are handled in the order they arrived, each worker has its own share of
+    ``queue_size``.
+    ``batch_callback`` is called with lists of up to ``batch_size`` ops instead of ``callback`` with each op.
+    """
+
+    def __init__(self, callback=None, workers: int = 4, queue_size: int = 10000, key=None, batch_callback=None,
+                 batch_size: int = 100):
+        if callback is None and batch_callback is None:
+            raise ValueError('a callback or a batch callback is needed')
+        self.callback = callback
+        self.batch_callback = batch_callback
+        self.batch_size = batch_size
+        self.key = (lambda tx: tx.get(key)) if isinstance(key, str) else key
+        if self.key is None:
+            self.queues = [queue.Queue(queue_size)]
+        else:
+            self.queues = [queue.Queue(max(1, queue_size // workers)) for _ in range(workers)]
+        self.dropped = 0
+        self.handled = [0] * workers  # per worker, so no lock is needed
+        self.errors = [0] * workers
+        self.threads = [threading.Thread(target=self._work, args=(number, self.queues[number % len(self.queues)]),
+                                         name='dispatch_thread_{}'.format(number), daemon=True)
+                        for number in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, tx: dict) -> bool:
+        """Queues an op for the workers, returns False if it was dropped."""
+        if self.key is None:
+            target = self.queues[0]
+        else:
+            target = self.queues[hash(str(self.key(tx))) % len(self.queues)]
+        try:
+            target.put_nowait(tx)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                log.warning('Dispatch queue full, dropped {} ops so far.'.format(self.dropped))
+            return False
+        return True
+
+    def _work(self, number: int, source: queue.Queue):
+        while True:
+            tx = source.get()
+            if tx is None:
+                return
+            batch = [tx]
+            done = False
+            if self.batch_callback is not None:
+                while len(batch) < self.batch_size:
+                    try:
+                        tx = source.get_nowait()
+                    except queue.Empty:
+                        break
+                    if tx is None:
+                        done = True
+                        break
+                    batch.append(tx)
+            try:
+                if self.batch_callback is not None:
+                    self.batch_callback(batch)
+                else:
+                    self.callback(tx)
+            except Exception:
+                self.errors[number] += 1
+                log.exception('Callback failed.')
+            self.handled[number] += len(batch)
+            if done:
+                return
+
+    def depth(self):
+        return sum(source.qsize() for source in self.queues)
+
+    def stats(self):
+        return {'queued': self.depth(), 'handled': sum(self.handled), 'dropped': self.dropped,
+                'errors': sum(self.errors)}
+
+    def stop(self):
+        """Lets the workers handle the queued ops, then ends them."""
+        for number in range(len(self.threads)):
+            self.queues[number % len(self.queues)].put(None)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,85 @@
+from synthetic_chain import ChainGenerator, block_id
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import logging
+import random
+import json
+import time
+
+log = logging.getLogger('FakeNode')
+
+# Stand-in for a STEEM node answering the JSON-RPC calls of block_source.RpcBlockSource. The chain depends only on
+# the clock and the block numbers, so several fake nodes started with the same genesis and interval serve the same
+# blocks and can be given different delays and lags to test hedging and failover.
+
+
+class FakeNode(BaseHTTPRequestHandler):
+    # set by serve()
+    genesis = 0
+    interval = 3
+    generator = ChainGenerator()
+    delay = 0
+    jitter = 0
+    lag = 0
+
+    def head(self):
+        return int((time.time() - self.genesis) / self.interval) - self.lag
+
+    def answer(self, method, params):
+        if method == 'condenser_api.get_dynamic_global_properties':
+            head = self.head()
+            return {'head_block_number': head, 'last_irreversible_block_num': head - 20,
+                    'head_block_id': block_id(head)}
+        if method == 'condenser_api.get_block':
+            block_num = params[0]
+            if block_num > self.head():
+                return None
+            return self.generator.raw_block(block_num, self.genesis + block_num * self.interval)
+        raise ValueError('unknown method {}'.format(method))
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.delay + random.random() * self.jitter)
+        try:
+            response = {'jsonrpc': '2.0', 'id': request.get('id'),
+                        'result': self.answer(request.get('method'), request.get('params', []))}
+        except Exception as e:
+            response = {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'message': str(e)}}
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def serve(port: int, genesis: float, interval: float = 3, ops: int = 20, delay: float = 0, jitter: float = 0,
+          lag: int = 0):
+    handler = type('FakeNodeHandler', (FakeNode,), {'genesis': genesis, 'interval': interval,
+                                                    'generator': ChainGenerator(ops),
+                                                    'delay': delay, 'jitter': jitter, 'lag': lag})
+    server = ThreadingHTTPServer(('localhost', port), handler, bind_and_activate=False)
+    server.request_queue_size = 128  # the proxy asks several blocks at once
+    server.server_bind()
+    server.server_activate()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a synthetic STEEM chain over JSON-RPC.')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--genesis', type=float, default=1600000000, help='unix time of block 0')
+    parser.add_argument('--interval', type=float, default=3, help='seconds per block')
+    parser.add_argument('--ops', type=int, default=20, help='ops per block')
+    parser.add_argument('--delay', type=float, default=0, help='seconds added to every answer')
+    parser.add_argument('--jitter', type=float, default=0, help='up to this many seconds added at random')
+    parser.add_argument('--lag', type=int, default=0, help='blocks the node stays behind the chain')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+
+    log.info('Serving on port {}.'.format(args.port))
+    serve(args.port, args.genesis, args.interval, args.ops, args.delay, args.jitter, args.lag).serve_forever()
@@ -0,0 +1,162 @@
+# A subscription is either an op type like 'transfer' or a filter dict. Filter keys:
+#   'type'             op type, any type if missing
+#   'account'          account in any of ACCOUNT_FIELDS
+#   'permlink_prefix'  start of the permlink
+#   any other key      op field equal to the value (or containing it, for list fields like required_auths)
+# e.g. {'type': 'transfer', 'to': 'alice'}, {'type': 'custom_json', 'id': 'follow'}, {'account': 'bob'}
+ACCOUNT_FIELDS = ('from', 'to', 'author', 'voter', 'account', 'parent_author', 'owner', 'creator', 'delegator',
+                  'delegatee', 'curator', 'required_auths', 'required_posting_auths')
+SPECIAL_KEYS = ('type', 'account', 'permlink_prefix')
+
+
+def sub_key(sub):
+    """Hashable form of a subscription, raises ValueError for malformed ones."""
+    if isinstance(sub, str):
+        return sub
+    if not isinstance(sub, dict):
+        raise ValueError('subscription must be an op type or a filter dict, not {!r}'.format(sub))
+    for key, value in sub.items():
+        if not isinstance(key, str) or not isinstance(value, (str, int)) or isinstance(value, bool):
+            raise ValueError('filter values must be strings or numbers ({!r}: {!r})'.format(key, value))
+    return tuple(sorted(sub.items()))
+
+
+def check_subs(subs):
+    for sub in subs:
+        sub_key(sub)
+
+
+def _contains(value, wanted):
+    return value == wanted or (isinstance(value, list) and wanted in value)
+
+
+def matches(sub, tx: dict) -> bool:
+    if isinstance(sub, str):
+        return tx.get('type') == sub
+    for key, wanted in sub.items():
+        if key == 'type':
+            if tx.get('type') != wanted:
+                return False
+        elif key == 'account':
+            if not any(_contains(tx.get(field), wanted) for field in ACCOUNT_FIELDS):
+                return False
+        elif key == 'permlink_prefix':
+            if not isinstance(tx.get('permlink'), str) or not tx['permlink'].startswith(wanted):
+                return False
+        elif not _contains(tx.get(key), wanted):
+            return False
+    return True
+
+
+def matches_any(subs, tx: dict) -> bool:
+    return any(matches(sub, tx) for sub in subs)
+
+
+def types_of(subs):
+    """Op types the subscriptions can match, None if one of them matches every type."""
+    types = set()
+    for sub in subs:
+        if isinstance(sub, str):
+            types.add(sub)
+        elif 'type' in sub:
+            types.add(sub['type'])
+        else:
+            return None
+    return types
+
+
+def _bucket(sub):
+    """Index key of a subscription: its most selective field and value."""
+    if isinstance(sub, str):
+        return 'type', sub
+    if 'account' in sub:
+        return 'account', sub['account']
+    fields = sorted(key for key in sub if key not in SPECIAL_KEYS)
+    if fields:
+        return fields[0], sub[fields[0]]
+    if 'permlink_prefix' in sub:
+        return 'permlink_prefix', sub['permlink_prefix']
+    if 'type' in sub:
+        return 'type', sub['type']
+    return '*', None
+
+
+class SubscriptionIndex:
+    """Names of the clients subscribed to each op, found with a few dict lookups per op.
+
+    Every subscription is filed under one (field, value) bucket. An op probes the buckets of its type, of the values
+    of the fields used by any filter and of the permlink prefixes of the lengths in use; only the filters of these
+    buckets are checked completely.
+    """
+
+    def __init__(self):
+        self.buckets = {}  # (field, value): {subscription key: set of names}
+        self.filters = {}  # subscription key of a filter dict: the filter
+        self.fields = {}  # field: number of buckets filed under it
+        self.prefix_lengths = {}  # length: number of buckets with a permlink prefix of that length
+
+    def add(self, client_name, subs):
+        for sub in subs:
+            key = sub_key(sub)
+            bucket = _bucket(sub)
+            if bucket not in self.buckets:
+                self.buckets[bucket] = {}
+                self._count(bucket, 1)
+            self.buckets[bucket].setdefault(key, set()).add(client_name)
+            if not isinstance(sub, str):
+                self.filters[key] = sub
+
+    def remove(self, client_name, subs):
+        for sub in subs:
+            key = sub_key(sub)
+            bucket = _bucket(sub)
+            names = self.buckets.get(bucket, {}).get(key)
+            if names is None:
+                continue
+            names.discard(client_name)
+            if names:
+                continue
+            del self.buckets[bucket][key]
+            self.filters.pop(key, None)  # a subscription is always filed under the same bucket
+            if not self.buckets[bucket]:
+                del self.buckets[bucket]
+                self._count(bucket, -1)
+
+    def _count(self, bucket, step):
+        field, value = bucket
+        if field == 'permlink_prefix':
+            counts, field = self.prefix_lengths, len(value)
+        elif field in ('type', '*'):
+            return
+        else:
+            counts = self.fields
+        counts[field] = counts.get(field, 0) + step
+        if not counts[field]:
+            del counts[field]
+
+    def _probes(self, tx: dict):
+        probes = {('type', tx.get('type')), ('*', None)}
+        for field in self.fields:
+            for source in (ACCOUNT_FIELDS if field == 'account' else (field,)):
+                value = tx.get(source)
+                if isinstance(value, list):
+                    probes.update((field, item) for item in value if isinstance(item, (str, int)))
+                elif isinstance(value, (str, int)):
+                    probes.add((field, value))
+        permlink = tx.get('permlink')
+        if isinstance(permlink, str):
+            probes.update(('permlink_prefix', permlink[:length]) for length in self.prefix_lengths
+                          if len(permlink) >= length)
+        return probes
+
+    def match(self, tx: dict):
+        """Returns the names of the clients with a subscription matching the op."""
+        names = set()
+        for probe in self._probes(tx):
+            bucket = self.buckets.get(probe)
+            if bucket is None:
+                continue
+            for key, subscribers in bucket.items():
+                if isinstance(key, str) or matches(self.filters[key], tx):
+                    names.update(subscribers)
+        return names
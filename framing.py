@@ -0,0 +1,122 @@
+from collections import OrderedDict, deque
+import itertools
+import pickle
+import time
+
+MAX_DATAGRAM = 65000  # stays below the UDP payload limit of 65507 bytes
+FRAGMENT_OVERHEAD = 200  # room for the encoded fragment header
+
+BLOCK_FIELDS = ('block_num', 'block_id', 'previous', 'timestamp', 'irreversible_block_num')  # of a block message
+
+_message_ids = itertools.count()
+
+
+def fragments(payload: bytes, limit: int = MAX_DATAGRAM, codec=None):
+    """Splits an encoded message into datagrams of at most limit bytes.
+
+    Messages which fit are returned as they are, bigger ones become numbered 'fragment' messages encoded with codec
+    (pickle if None).
+    """
+    if len(payload) <= limit:
+        return [payload]
+    chunk_size = limit - FRAGMENT_OVERHEAD
+    view = memoryview(payload)
+    message_id = next(_message_ids)
+    count = (len(payload) + chunk_size - 1) // chunk_size
+    dumps = codec.dumps if codec is not None else pickle.dumps
+    return [dumps({'info': 'fragment', 'id': message_id, 'index': index, 'count': count,
+                          'data': bytes(view[index * chunk_size:(index + 1) * chunk_size])})
+            for index in range(count)]
+
+
+def seq_ranges(seqs):
+    """Packs sequence numbers into sorted [first, last] ranges of consecutive numbers."""
+    ranges = []
+    for seq in sorted(seqs):
+        if ranges and ranges[-1][1] == seq - 1:
+            ranges[-1][1] = seq
+        else:
+            ranges.append([seq, seq])
+    return ranges
+
+
+class Reassembler:
+    """Collects fragments until their message is complete.
+
+    At most max_messages incomplete messages are kept, the oldest one is dropped first. Messages which are not
+    complete after timeout seconds are dropped as well.
+    """
+
+    def __init__(self, max_messages: int = 64, timeout: float = 10):
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.pending = OrderedDict()  # id: [ 0: chunks  1: number of missing chunks  2: time of the first chunk]
+        self.dropped = 0
+
+    def add(self, fragment: dict):
+        """Returns the encoded message once all of its fragments arrived, None before."""
+        now = time.monotonic()
+        while self.pending and now - next(iter(self.pending.values()))[2] > self.timeout:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+
+        entry = self.pending.get(fragment['id'])
+        if entry is None:
+            while len(self.pending) >= self.max_messages:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            entry = self.pending[fragment['id']] = [[None] * fragment['count'], fragment['count'], now]
+        if entry[0][fragment['index']] is None:
+            entry[0][fragment['index']] = fragment['data']
+            entry[1] -= 1
+        if entry[1]:
+            return None
+        del self.pending[fragment['id']]
+        return b''.join(entry[0])
+
+
+class BlockAssembler:
+    """Collects the ops of each block until its block message arrived, then returns the blocks in order.
+
+    A block message carries the fields of BLOCK_FIELDS and the number of ops of the block sent to the client. A block
+    missing some of them is held while their retransmission is pending, at most hold seconds; later blocks wait behind
+    it.
+    """
+
+    def __init__(self, hold: float = 5):
+        self.hold = hold
+        self.ops = {}  # block_num: ops received so far
+        self.ends = deque()  # (arrival time, block message data) of the blocks not returned yet
+        self.last = None  # block_num of the last returned block
+        self.late = 0  # ops which arrived after their block was returned
+        self.incomplete = 0  # blocks returned without all of their ops
+
+    def add_op(self, tx: dict):
+        block_num = tx.get('block_num', 0)
+        if self.last is not None and block_num <= self.last:
+            self.late += 1
+            return
+        self.ops.setdefault(block_num, []).append(tx)
+
+    def add_end(self, header: dict):
+        self.ends.append((time.monotonic(), header))
+
+    def ready(self, waiting: bool = False):
+        """Returns the blocks which are complete, with waiting (retransmissions pending) incomplete ones are held."""
+        blocks = []
+        now = time.monotonic()
+        while self.ends:
+            arrived, header = self.ends[0]
+            ops = self.ops.get(header['block_num'], [])
+            if len(ops) < header.get('count', 0) and waiting and now - arrived < self.hold:
+                break
+            self.ends.popleft()
+            if len(ops) < header.get('count', 0):
+                self.incomplete += 1
+            block = {key: header.get(key) for key in BLOCK_FIELDS}
+            block['ops'] = sorted(ops, key=lambda tx: tx.get('trx_num', 0))  # retransmitted ops arrive late
+            self.last = block['block_num'] if self.last is None else max(self.last, block['block_num'])
+            for block_num in [x for x in self.ops if x <= self.last]:
+                del self.ops[block_num]
+            blocks.append(block)
+        return blocks
@@ -0,0 +1,142 @@
+import asyncio
+import bisect
+import time
+
+# upper bounds in seconds of the histogram buckets, the last bucket takes everything above
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _series(name: str, labels: dict):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(key, value) for key, value in sorted(labels.items())))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts))}
+
+
+class Metrics:
+    """Counters, gauges and latency histograms, kept as plain numbers in dicts so updating them costs next to nothing.
+
+    Series are named like Prometheus ones, 'name{label="value"}'. ``snapshot()`` is what the stats command returns,
+    ``exposition()`` the text served by the optional HTTP endpoint.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}  # series: value
+        self.gauges = {}  # series: value
+        self.histograms = {}  # series: Histogram
+        self.labels = {}  # series: labels, to forget the series of a client
+        self.names = {}  # (name, label items): series, saves formatting the series on every update
+        self.collectors = []  # functions setting gauges which are cheaper to read on demand, like queue depths
+
+    def _series(self, name: str, labels: dict):
+        key = (name,) + tuple(labels.items())
+        series = self.names.get(key)
+        if series is None:
+            series = self.names[key] = _series(name, labels)
+        return series
+
+    def inc(self, name: str, value=1, **labels):
+        series = self._series(name, labels)
+        if series not in self.counters:
+            self.counters[series] = 0
+            self.labels[series] = labels
+        self.counters[series] += value
+
+    def set(self, name: str, value, **labels):
+        series = self._series(name, labels)
+        self.gauges[series] = value
+        self.labels[series] = labels
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._series(name, labels)
+        histogram = self.histograms.get(series)
+        if histogram is None:
+            histogram = self.histograms[series] = Histogram()
+            self.labels[series] = labels
+        histogram.observe(value)
+
+    def forget(self, **labels):
+        """Drops every series carrying all of the given labels, e.g. those of a deleted client."""
+        for series in [series for series, known in self.labels.items()
+                       if all(known.get(key) == value for key, value in labels.items())]:
+            del self.labels[series]
+            self.counters.pop(series, None)
+            self.gauges.pop(series, None)
+            self.histograms.pop(series, None)
+        self.names = {key: series for key, series in self.names.items() if series in self.labels}
+
+    def collect(self):
+        for collector in self.collectors:
+            collector(self)
+
+    def snapshot(self):
+        self.collect()
+        return {'uptime': time.time() - self.started,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {series: histogram.as_dict() for series, histogram in self.histograms.items()}}
+
+    def exposition(self):
+        """The metrics in the Prometheus text exposition format."""
+        self.collect()
+        lines = ['proxy_uptime_seconds {:.3f}'.format(time.time() - self.started)]
+        lines += ['{} {}'.format(series, value) for series, value in sorted(self.counters.items())]
+        lines += ['{} {}'.format(series, value) for series, value in sorted(self.gauges.items())]
+        for series, histogram in sorted(self.histograms.items()):
+            name, _, labels = series.partition('{')
+            labels = labels.rstrip('}')
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in histogram.buckets] + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels + ',' if labels else '', bound,
+                                                                cumulative))
+            lines.append('{}_sum{} {}'.format(name, '{' + labels + '}' if labels else '', histogram.sum))
+            lines.append('{}_count{} {}'.format(name, '{' + labels + '}' if labels else '', histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def merge_snapshot(snapshot: dict, other: dict, **labels):
+    """Adds the series of the snapshot of another process to snapshot, labels added to every series tell them apart."""
+    extra = ','.join('{}="{}"'.format(key, value) for key, value in sorted(labels.items()))
+
+    def relabel(series):
+        name, brace, known = series.partition('{')
+        return '{}{{{}}}'.format(name, known[:-1] + ',' + extra if brace else extra)
+
+    for kind in ('counters', 'gauges', 'histograms'):
+        snapshot[kind].update((relabel(series), value) for series, value in other[kind].items())
+    return snapshot
+
+
+async def serve_http(metrics: Metrics, port: int, host: str = 'localhost'):
+    """Serves the exposition of metrics to every GET request on host:port."""
+    async def handle(reader, writer):
+        try:
+            await reader.readline()
+            while (await reader.readline()).strip():  # rest of the request head
+                pass
+            body = metrics.exposition().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,51 @@
+import ipaddress
+import socket
+import zlib
+
+# Every op of a mode is sent once to one of the `groups` multicast groups of the mode, chosen by its op type, so a
+# client subscribed to a few types only joins (and only receives) their groups. The addresses of the groups follow
+# each other from the base address on, those of irreversible right after the ones of head.
+MODE_INDEX = {'head': 0, 'irreversible': 1}
+
+
+def group_index(op_type: str, groups: int):
+    """Group of the op type, the same on the proxy and the clients."""
+    return zlib.crc32(op_type.encode()) % groups if groups > 1 else 0
+
+
+def group_addresses(base: str, mode: str, groups: int):
+    first = ipaddress.IPv4Address(base) + MODE_INDEX[mode] * groups
+    return [str(first + index) for index in range(groups)]
+
+
+def sender_socket(interface: str = '0.0.0.0', ttl: int = 1):
+    """Non-blocking socket sending to the groups through interface, also to receivers on the same host."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+    sock.setblocking(False)
+    return sock
+
+
+def receiver_socket(port: int):
+    """Non-blocking socket receiving what is sent to port, several clients of a host may bind the same port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    sock.setblocking(False)
+    return sock
+
+
+def _membership(interface: str, group: str):
+    return socket.inet_aton(group) + socket.inet_aton(interface)
+
+
+def join(sock, group: str, interface: str = '0.0.0.0'):
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, _membership(interface, group))
+
+
+def leave(sock, group: str, interface: str = '0.0.0.0'):
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, _membership(interface, group))
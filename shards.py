@@ -0,0 +1,116 @@
+from concurrent.futures import Future, TimeoutError
+import threading
+import itertools
+import logging
+import asyncio
+import struct
+import pickle
+import queue
+import zlib
+
+log = logging.getLogger('StreamProxy_shards')
+
+# With workers the proxy forks that many worker processes, each serving the clients whose name hashes to it. The parent
+# keeps reading the server socket and streaming blocks: it forwards the commands of a client to its worker and every
+# head block to all workers, which send from the same server socket. Parent and worker talk over a socket pair in
+# frames of a length and a pickled tuple:
+#   parent -> worker  ('block', block)  ('datagram', address, raw)  ('block_reply', id, block)  ('stats', id)
+#                     ('exit',)
+#   worker -> parent  ('get_block', id, block_num)  ('stats_reply', id, snapshot)  ('subs', union of subscriptions)
+FRAME = struct.Struct('<Q')
+
+
+def worker_of(client_name: str, workers: int):
+    """Worker serving a client, the same for every command of the client."""
+    return zlib.crc32(client_name.encode()) % workers
+
+
+def frame(message) -> bytes:
+    body = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    return FRAME.pack(len(body)) + body
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    """The next message from the other process, None once it closed the connection."""
+    try:
+        length = FRAME.unpack(await reader.readexactly(FRAME.size))[0]
+        return pickle.loads(await reader.readexactly(length))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+class ParentBlockSource:
+    """Block source of a worker: the head blocks the parent forwards, older ones asked from the parent.
+
+    ``feed()`` is called on the event loop of the worker, ``blocks()`` and ``get_block()`` run in executor threads like
+    those of every block source. At most ``backlog`` blocks wait for ``blocks()``, the oldest one is dropped first.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter, backlog: int = 100,
+                 timeout: float = 30):
+        self.loop = loop
+        self.writer = writer
+        self.queue = queue.Queue(backlog)
+        self.timeout = timeout
+        self.ids = itertools.count()
+        self.requests = {}  # id: Future of the block asked from the parent
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def feed(self, block):
+        """Queues a forwarded block, None ends blocks()."""
+        while True:
+            try:
+                self.queue.put_nowait(block)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def blocks(self):
+        while not self.queue.empty():  # forwarded while nobody was registered
+            self.queue.get_nowait()
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            yield block
+
+    def _send(self, message):
+        self.loop.call_soon_threadsafe(self.writer.write, frame(message))
+
+    def get_block(self, block_num: int):
+        future = Future()
+        with self.lock:
+            request_id = next(self.ids)
+            self.requests[request_id] = future
+        self._send(('get_block', request_id, block_num))
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            log.warning('The parent did not answer the request for block {}.'.format(block_num))
+            return None
+        finally:
+            with self.lock:
+                self.requests.pop(request_id, None)
+
+    def answer(self, request_id: int, block):
+        with self.lock:
+            future = self.requests.get(request_id)
+        if future is not None and not future.done():
+            future.set_result(block)
+
+    def close(self):
+        """Ends blocks() and the requests waiting for the parent, they run in threads the worker waits for."""
+        self.feed(None)
+        with self.lock:
+            for future in self.requests.values():
+                if not future.done():
+                    future.set_result(None)
+
+    def set_subs(self, subs: list):
+        """Tells the parent, its block source may filter by the union of the subscriptions of all workers."""
+        self.writer.write(frame(('subs', subs)))
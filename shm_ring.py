@@ -0,0 +1,133 @@
+import mmap
+import os
+import struct
+import tempfile
+
+# Layout of a ring file: header, then capacity bytes of records. Positions are absolute byte counts since the ring
+# was created, a record starts at DATA_OFFSET + position % capacity and never wraps around the end of the ring.
+# Before overwriting anything the writer reserves up to the end of the record it writes, readers check the reservation
+# after copying a record to find out whether it was overwritten meanwhile. Positions, sequence number and reservation
+# are read and written as aligned 8 byte words, which other processes never see half written.
+HEADER = struct.Struct('<8sQQQQ')  # magic, capacity, write position, next sequence number, reserved position
+POSITION, SEQ, RESERVED = 2, 3, 4  # 8 byte words of the header
+MAGIC = b'SPRING01'
+DATA_OFFSET = 64
+RECORD = struct.Struct('<IIQH')  # length of record (with padding) and payload, sequence number, type length
+PADDING = 0xFFFFFFFFFFFFFFFF  # sequence number of filler records at the end of the ring
+
+
+def default_path(port: int, mode: str, directory: str = None):
+    if directory is None:
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'steem_stream_proxy_{}_{}'.format(port, mode))
+
+
+class RingWriter:
+    """Single writer of a ring file, used by the proxy to publish every encoded op of a mode once."""
+
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self.capacity = capacity - capacity % 8
+        with open(path, 'wb') as file:
+            file.truncate(DATA_OFFSET + self.capacity)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), DATA_OFFSET + self.capacity)
+        self.position = 0
+        self.seq = 0
+        HEADER.pack_into(self.map, 0, MAGIC, self.capacity, 0, 0, 0)
+        self.words = memoryview(self.map).cast('Q')
+
+    def write(self, op_type: str, payload: bytes):
+        op_type = op_type.encode()
+        length = RECORD.size + len(op_type) + len(payload)
+        length += -length % 8
+        if length > self.capacity // 2:
+            raise ValueError('record of {} bytes does not fit into the ring'.format(length))
+        offset = self.position % self.capacity
+        filler = self.capacity - offset if self.capacity - offset < length else 0
+        self.words[RESERVED] = self.position + filler + length
+        if filler:  # fill up the end of the ring and start over
+            if filler >= RECORD.size:
+                RECORD.pack_into(self.map, DATA_OFFSET + offset, filler, 0, PADDING, 0)
+            self.position += filler
+            offset = 0
+        start = DATA_OFFSET + offset
+        RECORD.pack_into(self.map, start, length, len(payload), self.seq, len(op_type))
+        start += RECORD.size
+        self.map[start:start + len(op_type)] = op_type
+        start += len(op_type)
+        self.map[start:start + len(payload)] = payload
+        self.position += length
+        self.seq += 1
+        self.words[SEQ] = self.seq
+        self.words[POSITION] = self.position  # publishes the record
+
+    def close(self):
+        self.words.release()
+        self.map.close()
+        self.file.close()
+        os.remove(self.path)  # readers keep their mapping
+
+
+class RingReader:
+    """Reader of a ring file with its own cursor, starting at the newest record.
+
+    Readers which fall behind by more than the capacity of the ring are lapped: they skip to the newest record
+    and count the records they missed in ``lapped``.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.words = self.view.cast('Q')
+        magic, self.capacity, self.position, self.seq, _ = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a ring file'.format(path))
+        self.lapped = 0
+
+    def _skip(self):
+        """Skips to the newest record, counting the records missed."""
+        write_position, write_seq = self.words[POSITION], self.words[SEQ]
+        self.lapped += max(write_seq - self.seq, 0)
+        self.position, self.seq = write_position, write_seq
+
+    def read(self, types=None):
+        """Returns (sequence number, op type, payload) of every new record, only of the given op types if set."""
+        records = []
+        write_position, write_seq = self.words[POSITION], self.words[SEQ]
+        reserved = self.words[RESERVED]
+        if write_position < self.position:  # ring was created again
+            self.position, self.seq = write_position, write_seq
+        if reserved - self.position > self.capacity:
+            self._skip()
+            return records
+        while self.position < write_position:
+            offset = self.position % self.capacity
+            if self.capacity - offset < RECORD.size:
+                self.position += self.capacity - offset
+                continue
+            start = DATA_OFFSET + offset
+            length, payload_length, seq, type_length = RECORD.unpack_from(self.map, start)
+            start += RECORD.size
+            op_type = bytes(self.view[start:start + type_length]).decode(errors='replace')  # checked below
+            payload = None
+            if types is None or op_type in types:
+                payload = bytes(self.view[start + type_length:start + type_length + payload_length])
+            if self.words[RESERVED] - self.position > self.capacity:  # the writer got to the record
+                self._skip()
+                break
+            if seq == PADDING:
+                self.position += length
+                continue
+            self.position += length
+            self.seq = seq + 1
+            if payload is not None:
+                records.append((seq, op_type, payload))
+        return records
+
+    def close(self):
+        self.words.release()
+        self.view.release()
+        self.map.close()
+        self.file.close()
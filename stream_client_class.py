@@ -1,18 +1,48 @@
 import threading
+import itertools
+import asyncio
 import logging
 import socket
-import pickle
+import time
+
+from codec import CODECS, DEFAULT_CODEC, codec_of
+from dispatch import Dispatcher
+from filters import matches_any, types_of
+from framing import BlockAssembler, Reassembler, seq_ranges
+from multicast import group_index, join, leave, receiver_socket
+from shm_ring import RingReader
+
+
+NACK_TIMEOUT = 1  # seconds to wait for a retransmission before asking again
+NACK_ATTEMPTS = 3  # NACKs per missing message before it counts as lost
+MAX_MISSING = 4096  # missing messages tracked at once, older ones of a bigger gap count as lost right away
+SHM_POLL_INTERVAL = 0.005  # seconds between reads of the ring or the multicast socket (shm and multicast transport)
+REFRESH_INTERVAL = 20  # seconds between refreshes of the registration, the server's default ttl_seconds is 60
+
+
+class _QueueProtocol(asyncio.DatagramProtocol):
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+
+    def datagram_received(self, data, address):
+        self.queue.put_nowait(data)
 
 
 class StreamProxyClient:
     def __init__(self, name: str, mode: str, server_address: tuple, subs: list = None,
-                 log_level: int = None, log_level_listen: int = None):
+                 log_level: int = None, log_level_listen: int = None, batch: bool = False, transport: str = 'udp',
+                 codec: str = 'binary', fields=None, start_block: int = None, end_block: int = None,
+                 multicast_interface: str = '0.0.0.0', rcvbuf: int = None, blocks: bool = False):
         if mode not in ['head', 'irreversible']:
             raise ValueError('mode must be either \'head\' or \'irreversible\'')
+        if transport not in ['udp', 'shm', 'multicast']:
+            raise ValueError('transport must be one of \'udp\', \'shm\' or \'multicast\'')
+        if codec not in CODECS:
+            raise ValueError('codec must be one of {}'.format(', '.join(CODECS)))
 
         self.log = logging.getLogger('Client-{}'.format(name))
-        self.thread_log = logging.getLogger('Client-{}-listening_thread'.format(self.name))
-        self.generator_log = logging.getLogger('Client-{}-listening_thread'.format(self.name))
+        self.thread_log = logging.getLogger('Client-{}-listening_thread'.format(name))
+        self.generator_log = logging.getLogger('Client-{}-listening_thread'.format(name))
         if log_level:
             if log_level == 'ALL':
                 log_level = 0
@@ -28,61 +58,325 @@ class StreamProxyClient:
         self.myself_send = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.myself_send.settimeout(10)
         self.myself_recv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rcvbuf = rcvbuf  # bytes of the kernel receive buffers, the system default if None
+        if rcvbuf:
+            self.myself_recv.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
 
         self.address_server = server_address
         self.name = name
         self.mode = mode
         self.subs = subs
+        self.batch = batch  # ask the server to pack the ops of a block into as few datagrams as possible
+        self.transport = transport  # 'shm' reads the ops from the ring file of the server, only for the same host
+        self.ring = None
+        self.multicast_interface = multicast_interface  # interface to join the multicast groups on
+        self.mc_socket = None  # bound to the multicast port of the server once it sent its groups
+        self.mc_groups = {}  # group: address of the joined multicast groups
+        self.mc_info = None  # multicast_groups data sent by the server
+        self.group_seqs = {}  # group: [ 0: next sequence number  1: missing {seq: [time, NACKs]}  2: last NACK check]
+        self.fields = fields  # op fields to receive, a list or a dict of op type ('*' for the others): list
+        self.codec = CODECS[codec]  # wire format of the messages to the server, which answers in the same format
+        self.shared_codec = None  # format of the ring and the multicast groups as the server announced it
+        self.recv_timeout = SHM_POLL_INTERVAL if transport != 'udp' else 30
         self.running = False
         self.paused = False
+        self.from_block = None  # block to resume from on the next registration
+        self.start_block = start_block  # first block of the history the server sends before the live stream
+        self.end_block = end_block  # last block of the history, no live stream follows if set
+        self.last_block = None  # block_num of the latest received op
+        self.reassembler = Reassembler()  # collects fragments of messages bigger than a datagram
+        self.assembler = BlockAssembler() if blocks else None  # receive whole blocks instead of single ops
+        self.next_seq = None  # sequence number expected next from the server
+        self.missing = {}  # sequence number: [ 0: time of the last NACK  1: NACKs sent]
+        self.last_nack_check = 0
+        self.last_refresh = 0
+        self.counters = {'gaps': 0, 'retransmitted': 0, 'lost': 0, 'duplicates': 0, 'lapped': 0,
+                         'coalesced': 0}
 
         self.callable_everything = None  # fires every income (needs argument for incoming data)
         self.callable_chain_data = None  # what to do with TXs (needs argument for incoming data)
+        self.callable_chain_batch = None  # what to do with lists of TXs, used by the dispatch workers instead
+        self.callable_block = None  # what to do with whole blocks if created with blocks=True
+        self.dispatch_options = None  # set by set_dispatch()
+        self.dispatcher = None  # Dispatcher of the running listening thread
         self.callable_client_info = None  # what to do with client_info (needs argument for incoming data)
         self.callable_error = None  # what to do with errors (needs argument for incoming data)
         self.callable_client_delete = None  # what to do as client has been deleted
         self.callable_server_stopped = None  # what to do as server has stopped
         self.callable_pong = None  # what to do with pongs
 
+    def _register_message(self):
+        message = {'command': 'register', 'mode': self.mode, 'name': self.name, 'sequenced': True,
+                   'codec': self.codec.name}
+        self.next_seq = None
+        self.missing.clear()
+        self.group_seqs.clear()
+        self.last_refresh = time.monotonic()
+        if self.batch:
+            message['batch'] = True
+        if self.assembler is not None:
+            message['blocks'] = True
+        if self.transport != 'udp':
+            message['transport'] = self.transport
+        if self.fields is not None:
+            message['fields'] = self.fields
+        if self.start_block is not None and self.last_block is None:
+            message['start_block'] = self.start_block
+            if self.end_block is not None:
+                message['end_block'] = self.end_block
+        elif self.from_block is None and self.last_block is not None:
+            self.from_block = self.last_block + 1
+        if self.from_block is not None:
+            message['from_block'] = self.from_block
+            self.from_block = None
+        if self.subs:
+            message['subs'] = self.subs
+        return message
+
+    def _keep_alive(self):
+        """Refreshes the registration on the client's own schedule, the server only asks once the deadline passed."""
+        now = time.monotonic()
+        if now - self.last_refresh >= REFRESH_INTERVAL:
+            self.last_refresh = now
+            self.myself_send.sendto(self.codec.dumps({'command': 'refresh', 'name': self.name}), self.address_server)
+
+    def _send_nack(self, seqs, group=None):
+        message = {'command': 'nack', 'name': self.name, 'seqs': seq_ranges(seqs)[:1000]}
+        if group is not None:
+            message['group'] = group
+        self.myself_send.sendto(self.codec.dumps(message), self.address_server)
+
+    def _check_sequence(self, seq: int, group: int = None):
+        """Detects gaps in the sequence numbers, sends NACKs for them and tells whether the message is new.
+
+        The messages of each multicast group are numbered on their own, group tells which numbers seq belongs to.
+        """
+        now = time.monotonic()
+        if group is None:
+            next_seq, missing, last_nack_check = self.next_seq, self.missing, self.last_nack_check
+        else:
+            next_seq, missing, last_nack_check = self.group_seqs.setdefault(group, [None, {}, 0])
+        new = True
+        if next_seq is None or seq == next_seq:
+            next_seq = seq + 1
+        elif seq > next_seq:
+            gap = range(max(next_seq, seq - MAX_MISSING), seq)
+            self.counters['gaps'] += seq - next_seq
+            self.counters['lost'] += seq - next_seq - len(gap)
+            for x in gap:
+                missing[x] = [now, 1]
+            self._send_nack(gap, group)
+            next_seq = seq + 1
+        elif missing.pop(seq, None):
+            self.counters['retransmitted'] += 1
+        else:
+            self.counters['duplicates'] += 1
+            new = False
+
+        if missing and now - last_nack_check >= NACK_TIMEOUT:
+            last_nack_check = now
+            again = []
+            for x, nack in list(missing.items()):
+                if now - nack[0] < NACK_TIMEOUT:
+                    continue
+                if nack[1] >= NACK_ATTEMPTS:
+                    del missing[x]
+                    self.counters['lost'] += 1
+                else:
+                    nack[0] = now
+                    nack[1] += 1
+                    again.append(x)
+            if again:
+                self._send_nack(again, group)
+
+        if group is None:
+            self.next_seq, self.last_nack_check = next_seq, last_nack_check
+        else:
+            self.group_seqs[group][0], self.group_seqs[group][2] = next_seq, last_nack_check
+        return new
+
+    def _loads(self, raw):
+        """Decodes a message in the codec of the client or the one the server shares ops in, nothing else."""
+        codec = codec_of(raw)
+        if codec is not self.codec and codec is not self.shared_codec:
+            raise ValueError('unexpected {} message'.format(codec.name))
+        return codec.loads(raw)
+
+    def _share_codec(self, name):
+        """Accepts the codec of the ring or the multicast groups, pickle only if the client talks pickle itself."""
+        codec = CODECS.get(name)
+        if codec is None or codec.name == 'pickle' and self.codec.name != 'pickle':
+            self.log.error('Server shares the ops as {}, which this client does not accept.'.format(name))
+            return False
+        self.shared_codec = codec
+        return True
+
+    def _unpack(self, raw):
+        try:
+            data = self._loads(raw)
+        except Exception as e:
+            self.log.warning('Dropped undecodable message: {!r}'.format(e))
+            return
+        if isinstance(data, dict) and data.get('info') == 'fragment':
+            payload = self.reassembler.add(data)
+            if payload is not None:
+                yield from self._unpack(payload)
+        elif isinstance(data, dict) and data.get('info') == 'sequenced':
+            if self._check_sequence(data['seq']):
+                yield from self._unpack(data['data'])
+        elif isinstance(data, dict) and data.get('info') == 'shm_ring' and isinstance(data.get('data'), str):
+            if self.ring is not None:
+                self.ring.close()
+                self.ring = None
+            if self._share_codec(data.get('codec', DEFAULT_CODEC)):
+                self.ring = RingReader(data['data'])
+            yield data
+        elif isinstance(data, dict) and data.get('info') == 'multicast':
+            if data.get('mode') == self.mode and data.get('group') in self.mc_groups \
+                    and self._check_sequence(data['seq'], data['group']):
+                subs = self.subs or []
+                for message in self._unpack(data['data']):  # the groups only filter by type
+                    if message.get('info') != 'stream_data' or matches_any(subs, message['data']):
+                        yield message
+        elif isinstance(data, dict) and data.get('info') == 'multicast_groups' and isinstance(data.get('data'), dict):
+            if self._share_codec(data.get('codec', DEFAULT_CODEC)):
+                self.mc_info = data['data']
+                self._join_groups()
+            yield data
+        elif isinstance(data, dict) and data.get('info') == 'nack_lost':
+            missing = self.missing if data.get('group') is None else self.group_seqs.get(data['group'], [None, {}])[1]
+            for seq in data.get('data', []):
+                if missing.pop(seq, None):
+                    self.counters['lost'] += 1
+            yield data
+        elif isinstance(data, dict) and data.get('info') == 'stream_summary' and isinstance(data.get('data'), dict):
+            for start, end in data['data'].get('seqs', []):  # dropped by the server on purpose, do not NACK them
+                for seq in range(start, end + 1):
+                    if self.next_seq is None or seq >= self.next_seq:
+                        self._check_sequence(seq)
+                    else:
+                        self.missing.pop(seq, None)
+            self.counters['coalesced'] += data['data'].get('messages', 0)
+            self.log.warning('Server dropped {} messages of blocks {}-{}, this client is too slow.'.format(
+                data['data'].get('messages'), data['data'].get('first_block'), data['data'].get('last_block')))
+        elif isinstance(data, dict) and data.get('info') == 'stream_batch':
+            for payload in data.get('data', []):
+                yield from self._unpack(payload)
+        else:
+            yield data
+
+    def _read_ring(self):
+        """Returns the new ops matching the subscriptions in the ring as stream_data messages."""
+        if self.ring is None:
+            return []
+        lapped = self.ring.lapped
+        subs = self.subs or []
+        messages = []
+        for seq, _, payload in self.ring.read(types_of(subs)):
+            try:
+                messages.append(self.shared_codec.loads(payload))
+            except Exception as e:
+                self.counters['lost'] += 1
+                self.log.warning('Dropped undecodable ring record {}: {!r}'.format(seq, e))
+        if not all(isinstance(sub, str) for sub in subs):  # the ring only filters by type
+            messages = [message for message in messages if matches_any(subs, message['data'])]
+        if self.ring.lapped != lapped:
+            self.counters['lapped'] += self.ring.lapped - lapped
+            self.log.warning('Lapped by the server, missed {} ops.'.format(self.ring.lapped - lapped))
+        return messages
+
+    def _join_groups(self):
+        """Joins the multicast groups of the subscribed op types and leaves the others."""
+        if self.mc_info is None:
+            return
+        addresses = self.mc_info['groups']
+        if self.mc_socket is None:
+            self.mc_socket = receiver_socket(self.mc_info['port'])
+            if self.rcvbuf:
+                self.mc_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        types = types_of(self.subs or [])
+        if types is None:
+            wanted = set(range(len(addresses)))
+        else:
+            wanted = {group_index(op_type, len(addresses)) for op_type in types}
+        for group in wanted - set(self.mc_groups):
+            join(self.mc_socket, addresses[group], self.multicast_interface)
+            self.mc_groups[group] = addresses[group]
+        for group in set(self.mc_groups) - wanted:
+            leave(self.mc_socket, self.mc_groups.pop(group), self.multicast_interface)
+        self.log.debug('Joined multicast groups {!s}.'.format(sorted(self.mc_groups.values())))
+
+    def _read_multicast(self):
+        """Returns the new ops of the joined multicast groups matching the subscriptions as stream_data messages."""
+        messages = []
+        while self.mc_socket is not None:
+            try:
+                raw = self.mc_socket.recv(65536)
+            except BlockingIOError:
+                break
+            messages.extend(self._unpack(raw))
+        return messages
+
     def set_subscriptions(self, subs: list = None):
-        if subs:
+        if subs is not None:
             self.subs = subs
         self.log.info('Setting subscriptions on server side: {!s}'.format(self.subs))
-        self.myself_send.sendto(pickle.dumps({'command': 'set_subs', 'name': self.name, 'subs': subs}),
+        self.myself_send.sendto(self.codec.dumps({'command': 'set_subs', 'name': self.name, 'subs': subs}),
                                 self.address_server)
+        self._join_groups()
 
     def add_subscriptions(self, subs: list):
-        self.myself_send.sendto(pickle.dumps({'command': 'add_subs', 'name': self.name, 'subs': subs}),
+        self.myself_send.sendto(self.codec.dumps({'command': 'add_subs', 'name': self.name, 'subs': subs}),
                                 self.address_server)
         [self.subs.append(x) for x in subs if x not in self.subs]
+        self._join_groups()
         self.log.info('Adding subscriptions on server side to: {!s}'.format(self.subs))
 
     def rem_subscriptions(self, subs: list):
-        self.myself_send.sendto(pickle.dumps({'command': 'rem_subs', 'name': self.name, 'subs': subs}),
+        self.myself_send.sendto(self.codec.dumps({'command': 'rem_subs', 'name': self.name, 'subs': subs}),
                                 self.address_server)
         [self.subs.remove(x) for x in subs if x in self.subs]
+        self._join_groups()
         self.log.info('Removing subscriptions on server side to: {!s}'.format(self.subs))
 
     def get_info(self):
         if self.running:
-            self.myself_send.sendto(pickle.dumps({'command': 'info', 'name': self.name}),
+            self.myself_send.sendto(self.codec.dumps({'command': 'info', 'name': self.name}),
                                     self.address_server)
         else:
             self.log.info('Could not ask for client info since not connected to server.')
 
+    def get_stats(self):
+        """Asks the server for its metrics, returns them as a dict or None if it does not answer."""
+        self.myself_send.sendto(self.codec.dumps({'command': 'stats', 'name': self.name}), self.address_server)
+        reassembler = Reassembler()
+        try:
+            while True:
+                data = self._loads(self.myself_send.recvfrom(65535)[0])
+                if data.get('info') == 'fragment':
+                    data = reassembler.add(data)
+                    if data is None:
+                        continue
+                    data = self._loads(data)
+                if data.get('info') == 'stats':
+                    return data.get('data')
+        except (ConnectionResetError, socket.timeout):
+            self.log.info('Server did not answer the stats request.')
+            return None
+
     def refresh(self):
-        self.myself_send.sendto(pickle.dumps({'command': 'refresh', 'name': self.name}),
+        self.myself_send.sendto(self.codec.dumps({'command': 'refresh', 'name': self.name}),
                                 self.address_server)
         self.log.info('Refreshed connection.')
 
     def ping(self):
-        self.myself_send.sendto(pickle.dumps({'command': 'ping', 'name': self.name}),
+        self.myself_send.sendto(self.codec.dumps({'command': 'ping', 'name': self.name}),
                                 self.address_server)
         self.log.info('Sending ping.')
         if not self.running:
             try:
                 while True:
-                    data = pickle.loads(self.myself_send.recvfrom(64)[0])
+                    data = self._loads(self.myself_send.recvfrom(64)[0])
                     if data.get('info') == 'ping_answer':
                         if self.callable_everything:
                             self.callable_everything(data)
@@ -96,17 +390,34 @@ class StreamProxyClient:
                 self.log.info('Connection timed out on pinged port.')
 
     def stop(self):
-        self.myself_send.sendto(pickle.dumps({'command': 'stop'}), self.address_server)
+        self.myself_send.sendto(self.codec.dumps({'command': 'stop'}), self.address_server)
         self.log.info('Sending stop signal to server.')
 
-    def start_listen(self, subs: list = None, join=False):
+    def set_dispatch(self, workers: int = 4, queue_size: int = 10000, key=None, batch_size: int = 100):
+        """Lets start_listen() run the TX callbacks on worker threads instead of the listening thread.
+
+        The listening thread then only receives and queues; TXs finding the queue full are dropped and counted in
+        dispatch_stats(). key (an op field like 'type' or a function of the TX) keeps the TXs of each key in order.
+        callable_chain_batch, if set, gets lists of up to batch_size TXs instead of callable_chain_data single ones.
+        workers=0 switches back to calling callable_chain_data on the listening thread.
+        """
+        self.dispatch_options = {'workers': workers, 'queue_size': queue_size, 'key': key,
+                                 'batch_size': batch_size} if workers else None
+
+    def dispatch_stats(self):
+        """Queue depth and counters of the dispatch workers (queued, handled, dropped, errors), None without."""
+        return self.dispatcher.stats() if self.dispatcher is not None else None
+
+    def start_listen(self, subs: list = None, join=False, from_block: int = None):
         if self.running or [True for x in threading.enumerate() if x.name == 'listen_thread']:
             raise RuntimeError('Already listening or thread has not ended yet.')
         if subs:
             self.subs = subs
+        if from_block is not None:
+            self.from_block = from_block
         self.running = True
         self.paused = False
-        self.myself_recv.settimeout(30)
+        self.myself_recv.settimeout(self.recv_timeout)
         t = threading.Thread(target=self._listen_thread, name='listen_thread')
         t.start()
         self.log.info('Starting listening with subs: {}.'.format(self.subs))
@@ -120,7 +431,7 @@ class StreamProxyClient:
             self.log.info('Stopping listening.')
             self.running = False
             self.paused = False
-            self.myself_recv.settimeout(30)
+            self.myself_recv.settimeout(self.recv_timeout)
             try:
                 [x.join() for x in threading.enumerate() if x.name == 'listen_thread']
             except:
@@ -132,7 +443,7 @@ class StreamProxyClient:
             self.log.info('Already paused.')
         elif self.running:
             self.myself_recv.settimeout(None)
-            self.myself_send.sendto(pickle.dumps({'command': 'unregister', 'name': self.name}),
+            self.myself_send.sendto(self.codec.dumps({'command': 'unregister', 'name': self.name}),
                                     self.address_server)
             self.paused = True
             self.log.info('Paused streaming.')
@@ -141,11 +452,8 @@ class StreamProxyClient:
 
     def unpause(self):
         if self.paused and self.running:
-            self.myself_recv.settimeout(30)
-            self.myself_recv.sendto(pickle.dumps(
-                [{'command': 'register', 'mode': self.mode, 'name': self.name},
-                 {'command': 'set_subs', 'subs': self.subs, 'name': self.name}]
-            ), self.address_server)
+            self.myself_recv.settimeout(self.recv_timeout)
+            self.myself_recv.sendto(self.codec.dumps(self._register_message()), self.address_server)
             self.paused = False
             self.log.info('Unpaused streaming.')
         elif self.running:
@@ -154,7 +462,18 @@ class StreamProxyClient:
             self.log.info('Not running.')
 
     def _listen_thread(self):
-        self.myself_recv.settimeout(30)  # set timeout for receiving messages from server
+        self.dispatcher = None
+        if self.dispatch_options is not None:
+            self.dispatcher = Dispatcher(self.callable_chain_data, batch_callback=self.callable_chain_batch,
+                                         **self.dispatch_options)
+        try:
+            return self._listen()
+        finally:
+            if self.dispatcher is not None:
+                self.dispatcher.stop()
+
+    def _listen(self):
+        self.myself_recv.settimeout(self.recv_timeout)  # set timeout for receiving messages from server
 
         if self.log_level_listen:
             if self.log_level_listen == 'ALL':
@@ -168,86 +487,106 @@ class StreamProxyClient:
 
         if self.subs:
             self.thread_log.info('Subscribing mode "{}" with subs {!s}.'.format(self.mode, self.subs))
-            self.myself_recv.sendto(pickle.dumps(
-                [{'command': 'register', 'mode': self.mode, 'name': self.name},
-                 {'command': 'set_subs', 'subs': self.subs, 'name': self.name}]
-            ), self.address_server)
         else:
             self.thread_log.info('Subscribing mode "{}" without subs.'.format(self.mode))
-            self.myself_recv.sendto(pickle.dumps({'command': 'register', 'mode': self.mode, 'name': self.name}),
-                                    self.address_server)
+        self.myself_recv.sendto(self.codec.dumps(self._register_message()), self.address_server)
 
+        last_received = time.monotonic()
         while self.running:
             try:
-                data, address = self.myself_recv.recvfrom(65536)
-                data = pickle.loads(data)
-                self.thread_log.log(5, data)
-                if data.get('info') and data.get('name') == self.name:
-                    self.thread_log.debug(data)
-                    if self.callable_everything:
-                        self.callable_everything(data)
-
-                    if data['info'] == 'stream_data' and isinstance(data.get('data'), dict):  # got block chain data
-                        if self.callable_chain_data:
-                            self.callable_chain_data(data.get('data'))
-                        self.thread_log.log(5, 'Received stream data: {}'.format(data.get('data')))
-                    elif data['info'] == 'client_info' and isinstance(data.get('data'), list):  # requested client info
-                        if self.callable_client_info:
-                            self.callable_client_info(data.get('data'))
-                        self.thread_log.info('Received client info data: {}'.format(data.get('data')))
-
-                    elif data['info'] == 'error' and isinstance(data.get('data'), str):  # error in server
-                        if self.callable_error:
-                            self.callable_error(data.get('data'))
-                        self.thread_log.error('Received error message: {}.'.format(data.get('data')))
-
-                    elif data['info'] == 'refresh_req':
-                        self.myself_send.sendto(pickle.dumps([{'command': 'refresh', 'name': self.name}]),
-                                                self.address_server)
-                        self.thread_log.debug('Refreshed subscription.')
-
-                    elif data['info'] == 'client_delete':
-                        if self.callable_client_delete:
-                            self.callable_client_delete()
-                            self.thread_log.info('Client was deleted from server.')
-                        self.running = False
-
-                    elif data['info'] == 'stop':
-                        if self.callable_server_stopped:
-                            self.callable_server_stopped()
-                        self.thread_log.info('Server shut down.')
-                        self.running = False
+                messages = self._read_ring() + self._read_multicast()
+                try:
+                    raw, address = self.myself_recv.recvfrom(65536)
+                    messages = itertools.chain(messages, self._unpack(raw))
+                except socket.timeout:
+                    if not messages and (self.ring is None and self.mc_socket is None
+                                         or time.monotonic() - last_received >= 30):
+                        raise
+                last_received = time.monotonic()
+                self._keep_alive()
+                for data in messages:
+                    self.thread_log.log(5, data)
+                    if data.get('info') and data.get('name', self.name) == self.name:  # stream_data carries no name
+                        self.thread_log.debug(data)
+                        if self.callable_everything:
+                            self.callable_everything(data)
 
-                    elif data['info'] == 'ping_answer':
-                        if self.callable_pong:
-                            self.callable_pong()
-                        self.thread_log.info('Received pong.')
+                        if data['info'] == 'stream_data' and isinstance(data.get('data'), dict):  # chain data
+                            self.last_block = max(self.last_block or 0, data['data'].get('block_num', 0))
+                            if self.assembler is not None:
+                                self.assembler.add_op(data['data'])
+                            elif self.dispatcher is not None:
+                                self.dispatcher.put(data['data'])
+                            elif self.callable_chain_data:
+                                self.callable_chain_data(data.get('data'))
+                            self.thread_log.log(5, 'Received stream data: %s', data.get('data'))
+                        elif data['info'] == 'block' and isinstance(data.get('data'), dict):  # end of a block
+                            if self.assembler is not None:
+                                self.assembler.add_end(data['data'])
+                        elif data['info'] == 'client_info' and isinstance(data.get('data'), list):  # client info
+                            if self.callable_client_info:
+                                self.callable_client_info(data.get('data'))
+                            self.thread_log.info('Received client info data: {}'.format(data.get('data')))
+
+                        elif data['info'] == 'error' and isinstance(data.get('data'), str):  # error in server
+                            if self.callable_error:
+                                self.callable_error(data.get('data'))
+                            self.thread_log.error('Received error message: {}.'.format(data.get('data')))
+
+                        elif data['info'] == 'refresh_req':
+                            self.myself_send.sendto(self.codec.dumps([{'command': 'refresh', 'name': self.name}]),
+                                                    self.address_server)
+                            self.thread_log.debug('Refreshed subscription.')
+
+                        elif data['info'] == 'client_delete':
+                            if self.callable_client_delete:
+                                self.callable_client_delete()
+                                self.thread_log.info('Client was deleted from server.')
+                            self.running = False
+
+                        elif data['info'] == 'stop':
+                            if self.callable_server_stopped:
+                                self.callable_server_stopped()
+                            self.thread_log.info('Server shut down.')
+                            self.running = False
+
+                        elif data['info'] == 'ping_answer':
+                            if self.callable_pong:
+                                self.callable_pong()
+                            self.thread_log.info('Received pong.')
+
+                        elif data['info'] == 'backfill_done' and isinstance(data.get('data'), dict):
+                            self.thread_log.info('Backfill done up to block {}.'.format(
+                                data['data'].get('last_block')))
+                            if not data['data'].get('live'):
+                                self.running = False
+
+                for block in self._ready_blocks():
+                    if self.callable_block:
+                        self.callable_block(block)
 
             except ConnectionResetError:
                 self.thread_log.error('connection refused. Server offline.')
                 return 2
             except socket.timeout:
-                self.myself_send.sendto(pickle.dumps({'command': 'is_registered', 'name': self.name}),
+                self.myself_send.sendto(self.codec.dumps({'command': 'is_registered', 'name': self.name}),
                                         self.address_server)
                 try:
-                    response = pickle.loads(self.myself_send.recvfrom(512))
-                    if response.get('info') == 'registered' and response.get('data'):
+                    response = self._loads(self.myself_send.recvfrom(512)[0])
+                    if response.get('info') == 'registered' and 'data' in response:
                         if response['data'] is True:
                             self.thread_log.info('Online and registered.')
                         else:
                             self.thread_log.info('Online and not registered.')
-                            self.myself_recv.sendto(pickle.dumps(
-                                [{'command': 'register', 'mode': self.mode, 'name': self.name},
-                                 {'command': 'set_subs', 'subs': self.subs, 'name': self.name}]
-                            ), self.address_server)
+                            self.myself_recv.sendto(self.codec.dumps(self._register_message()), self.address_server)
                 except ConnectionResetError:
                     self.thread_log.error('connection refused. Server offline.')
                     return 2
                 except socket.timeout:
-                    self.myself_send.sendto(pickle.dumps({'command': 'ping'}),
+                    self.myself_send.sendto(self.codec.dumps({'command': 'ping'}),
                                             self.address_server)
                     try:
-                        response = pickle.loads(self.myself_send.recvfrom(512))
+                        response = self._loads(self.myself_send.recvfrom(512)[0])
                         if response.get('info') == 'ping_answer':
                             self.thread_log.info('Online.')
                     except ConnectionResetError:
@@ -258,15 +597,16 @@ class StreamProxyClient:
                         return 2
 
         if not self.paused:
-            self.myself_send.sendto(pickle.dumps({'command': 'unregister', 'name': self.name}),
+            self.myself_send.sendto(self.codec.dumps({'command': 'unregister', 'name': self.name}),
                                     self.address_server)
         else:
             self.paused = False
 
-    def stream(self):
+    def _prepare_generator(self, from_block: int = None):
+        if from_block is not None:
+            self.from_block = from_block
         self.running = True
         self.paused = False
-        self.myself_recv.settimeout(None)  # set to blocking mode
 
         if self.log_level_listen:
             if self.log_level_listen == 'ALL':
@@ -280,44 +620,124 @@ class StreamProxyClient:
 
         if self.subs:
             self.generator_log.info('Subscribing mode "{}" with subs {!s}.'.format(self.mode, self.subs))
-            self.myself_recv.sendto(pickle.dumps(
-                [{'command': 'register', 'mode': self.mode, 'name': self.name},
-                 {'command': 'set_subs', 'subs': self.subs, 'name': self.name}]
-            ), self.address_server)
         else:
             self.generator_log.info('Subscribing mode "{}" without subs.'.format(self.mode))
-            self.myself_recv.sendto(pickle.dumps({'command': 'register', 'mode': self.mode, 'name': self.name}),
-                                    self.address_server)
 
-        while self.running:
-            data, address = self.myself_recv.recvfrom(65536)
-            data = pickle.loads(data)
-            self.generator_log.log(5, data)
-            if data['info'] == 'stream_data' and isinstance(data.get('data'), dict):  # got block chain data
-                self.generator_log.log(5, 'Received stream data: {}'.format(data.get('data')))
-                yield data.get('data')
+    def _generator_message(self, data):
+        """Handles a message received by stream() or astream(), returns the op if it is stream data.
 
-            elif data['info'] == 'client_info' and isinstance(data.get('data'), list):  # got requested client info
-                self.generator_log.info('Received client info data: {}'.format(data.get('data')))
+        With blocks=True the ops are collected for their block instead, see _ready_blocks().
+        """
+        self.generator_log.log(5, data)
+        if data['info'] == 'stream_data' and isinstance(data.get('data'), dict):  # got block chain data
+            self.last_block = max(self.last_block or 0, data['data'].get('block_num', 0))
+            self.generator_log.log(5, 'Received stream data: %s', data.get('data'))
+            if self.assembler is not None:
+                self.assembler.add_op(data['data'])
+                return None
+            return data.get('data')
 
-            elif data['info'] == 'error' and isinstance(data.get('data'), str):  # error in server
-                self.generator_log.error('Received error message: {}.'.format(data.get('data')))
+        elif data['info'] == 'block' and isinstance(data.get('data'), dict):  # all ops of the block were sent
+            if self.assembler is not None:
+                self.assembler.add_end(data['data'])
 
-            elif data['info'] == 'refresh_req':
-                self.myself_send.sendto(pickle.dumps([{'command': 'refresh', 'name': self.name}]),
-                                        self.address_server)
-                self.generator_log.debug('Refreshed subscription.')
+        elif data['info'] == 'client_info' and isinstance(data.get('data'), list):  # got requested client info
+            self.generator_log.info('Received client info data: {}'.format(data.get('data')))
 
-            elif data['info'] == 'client_delete':
-                self.generator_log.info('Client was deleted from server.')
-                self.running = False
+        elif data['info'] == 'error' and isinstance(data.get('data'), str):  # error in server
+            self.generator_log.error('Received error message: {}.'.format(data.get('data')))
 
-            elif data['info'] == 'stop':
-                self.generator_log.info('Server shut down.')
-                self.running = False
+        elif data['info'] == 'refresh_req':
+            self.myself_send.sendto(self.codec.dumps([{'command': 'refresh', 'name': self.name}]),
+                                    self.address_server)
+            self.generator_log.debug('Refreshed subscription.')
 
-            elif data['info'] == 'ping_answer':
-                self.generator_log.info('Received pong.')
+        elif data['info'] == 'client_delete':
+            self.generator_log.info('Client was deleted from server.')
+            self.running = False
 
-        self.running = False
-        self.paused = False
+        elif data['info'] == 'stop':
+            self.generator_log.info('Server shut down.')
+            self.running = False
+
+        elif data['info'] == 'ping_answer':
+            self.generator_log.info('Received pong.')
+
+        elif data['info'] == 'backfill_done' and isinstance(data.get('data'), dict):
+            self.generator_log.info('Backfill done up to block {}.'.format(data['data'].get('last_block')))
+            if not data['data'].get('live'):
+                self.running = False
+        return None
+
+    def _ready_blocks(self, waiting: bool = True):
+        """The blocks completed so far with blocks=True, held back while retransmissions are pending."""
+        if self.assembler is None:
+            return []
+        blocks = self.assembler.ready(waiting and bool(self.missing))
+        if blocks:
+            self.last_block = max(self.last_block or 0, blocks[-1]['block_num'])
+        return blocks
+
+    def stream(self, from_block: int = None, timeout: float = None):
+        """Yields the received ops, or whole blocks like a block source delivers them if created with blocks=True.
+
+        With timeout (UDP transport only) the stream ends once nothing arrived for that many seconds.
+        """
+        self._prepare_generator(from_block)
+        self.myself_recv.settimeout(SHM_POLL_INTERVAL if self.transport != 'udp' else timeout)  # blocking for udp
+        self.myself_recv.sendto(self.codec.dumps(self._register_message()), self.address_server)
+
+        try:
+            while self.running:
+                messages = self._read_ring() + self._read_multicast()
+                try:
+                    raw, address = self.myself_recv.recvfrom(65536)
+                    messages = itertools.chain(messages, self._unpack(raw))
+                except socket.timeout:
+                    if self.transport == 'udp':
+                        self.generator_log.info('Nothing received for {}s, stopping.'.format(timeout))
+                        self.running = False
+                self._keep_alive()
+                for data in messages:
+                    tx = self._generator_message(data)
+                    if tx is not None:
+                        yield tx
+                yield from self._ready_blocks()
+            yield from self._ready_blocks(False)
+        finally:
+            self.running = False
+            self.paused = False
+            if self.myself_send.fileno() != -1:  # also when a finished backfill ends the stream
+                self.myself_send.sendto(self.codec.dumps({'command': 'unregister', 'name': self.name}),
+                                        self.address_server)
+
+    async def astream(self, from_block: int = None):
+        """Async counterpart of stream(), use it with ``async for tx in client.astream()``."""
+        self._prepare_generator(from_block)
+        queue = asyncio.Queue()
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _QueueProtocol(queue), local_addr=('0.0.0.0', 0))
+        try:
+            transport.sendto(self.codec.dumps(self._register_message()), self.address_server)
+            while self.running:
+                messages = self._read_ring() + self._read_multicast()
+                try:
+                    if self.ring is None and self.mc_socket is None:
+                        raw = await queue.get()
+                    else:
+                        raw = await asyncio.wait_for(queue.get(), SHM_POLL_INTERVAL)
+                    messages = itertools.chain(messages, self._unpack(raw))
+                except asyncio.TimeoutError:
+                    pass
+                self._keep_alive()
+                for data in messages:
+                    tx = self._generator_message(data)
+                    if tx is not None:
+                        yield tx
+                for block in self._ready_blocks():
+                    yield block
+        finally:
+            transport.sendto(self.codec.dumps({'command': 'unregister', 'name': self.name}), self.address_server)
+            transport.close()
+            self.running = False
+            self.paused = False
@@ -1,21 +1,66 @@
-from beem.steem import Steem
-from beem.blockchain import Blockchain
-from beem.instance import set_shared_steem_instance
+from block_source import source_from_config
+from block_store import BlockStore
+from codec import CODECS, DEFAULT_CODEC, codec_of
+from filters import SubscriptionIndex, check_subs, matches_any, sub_key
+from framing import fragments, seq_ranges, BLOCK_FIELDS, MAX_DATAGRAM
+from metrics import Metrics, merge_snapshot, serve_http
+from multicast import group_addresses, group_index, sender_socket
+from shards import ParentBlockSource, frame, read_frame, worker_of
+from shm_ring import RingWriter, default_path
 
-from copy import copy
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import configparser
-import threading
+import asyncio
+import itertools
+import heapq
+import signal
+import socket
+import struct
 from logging.handlers import TimedRotatingFileHandler
 import logging
-import socket
 import pickle
+import time
 import os
 
 config = configparser.ConfigParser()
 config.read('server_config.ini')
-set_shared_steem_instance(Steem(node=config.get('STEEM_SETTINGS', 'node', fallback='https://anyx.io')))
-standard_ttl = config.get('PROXY_SETTINGS', 'ttl', fallback=20)  # 20 for default, 5 for tests
-ttl_tolerance = config.get('PROXY_SETTINGS', 'ttl_tolerance', fallback=2)  # 5 for default, 2 for tests
+block_source = source_from_config(config)
+standard_ttl = config.getfloat('PROXY_SETTINGS', 'ttl_seconds', fallback=60)  # a refresh keeps a client alive
+ttl_tolerance = config.getfloat('PROXY_SETTINGS', 'ttl_tolerance_seconds', fallback=10)  # after the refresh_req
+replay_buffer_blocks = config.getint('PROXY_SETTINGS', 'replay_buffer_blocks', fallback=200)
+replay_buffer_bytes = config.getint('PROXY_SETTINGS', 'replay_buffer_bytes', fallback=0)  # 0 for no byte limit
+max_datagram = config.getint('PROXY_SETTINGS', 'max_datagram', fallback=MAX_DATAGRAM)  # bigger messages are split
+batch_size = config.getint('PROXY_SETTINGS', 'batch_size', fallback=60000)  # max bytes of a batched datagram
+batch_window = config.getfloat('PROXY_SETTINGS', 'batch_window', fallback=0)  # seconds, 0 to flush every block
+retransmit_buffer = config.getint('PROXY_SETTINGS', 'retransmit_buffer', fallback=1024)  # messages per client
+send_queue = config.getint('PROXY_SETTINGS', 'send_queue', fallback=1024)  # messages waiting per client
+slow_policy = config.get('PROXY_SETTINGS', 'slow_policy', fallback='drop_oldest')  # what to do if a queue is full
+if slow_policy not in ['drop_oldest', 'drop_newest', 'coalesce', 'evict']:
+    raise ValueError('unknown slow_policy "{}"'.format(slow_policy))
+allow_pickle = config.getboolean('PROXY_SETTINGS', 'allow_pickle', fallback=False)  # accept pickled commands
+ring_codec = CODECS[config.get('PROXY_SETTINGS', 'ring_codec', fallback=DEFAULT_CODEC)]  # also used for multicast
+shm_transport = config.getboolean('PROXY_SETTINGS', 'shm_transport', fallback=False)  # ring files for local clients
+shm_size = config.getint('PROXY_SETTINGS', 'shm_size', fallback=64 * 1024 * 1024)  # bytes per mode
+multicast = config.getboolean('PROXY_SETTINGS', 'multicast', fallback=False)  # send every op once to a group
+multicast_group = config.get('PROXY_SETTINGS', 'multicast_group', fallback='239.255.42.1')  # address of the first
+multicast_groups = config.getint('PROXY_SETTINGS', 'multicast_groups', fallback=1)  # groups per mode, by op type
+multicast_port = config.getint('PROXY_SETTINGS', 'multicast_port', fallback=8081)
+multicast_interface = config.get('PROXY_SETTINGS', 'multicast_interface', fallback='0.0.0.0')  # 127.0.0.1 for lo
+multicast_ttl = config.getint('PROXY_SETTINGS', 'multicast_ttl', fallback=1)  # 1 keeps it in the local network
+multicast_buffer = config.getint('PROXY_SETTINGS', 'multicast_buffer', fallback=8192)  # messages kept per group
+backfill_workers = config.getint('PROXY_SETTINGS', 'backfill_workers', fallback=8)  # parallel historical fetches
+metrics_port = config.getint('PROXY_SETTINGS', 'metrics_port', fallback=0)  # HTTP port of the metrics, 0 for none
+block_store_dir = config.get('PROXY_SETTINGS', 'block_store', fallback='')  # directory of the block store, '' for none
+block_store_bytes = config.getint('PROXY_SETTINGS', 'block_store_bytes', fallback=0)  # retention, 0 for no limit
+block_store_segment = config.getint('PROXY_SETTINGS', 'block_store_segment', fallback=10000)  # blocks per segment
+state_file = config.get('PROXY_SETTINGS', 'state_file', fallback='')  # snapshot of the registry, '' for none
+state_interval = config.getfloat('PROXY_SETTINGS', 'state_interval', fallback=10)  # seconds between snapshots
+handover_socket = config.get('PROXY_SETTINGS', 'handover_socket', fallback='')  # unix socket path, '' for none
+shard_workers = config.getint('PROXY_SETTINGS', 'workers', fallback=0)  # processes serving the clients, 0 for none
+shard_backlog = config.getint('PROXY_SETTINGS', 'worker_backlog', fallback=64 * 1024 * 1024)  # bytes per worker
+upstream_retry = config.getfloat('PROXY_SETTINGS', 'upstream_retry', fallback=5)  # seconds to restart a failed source
 
 handlers = []
 if config.getboolean('LOGGING', 'log_to_file', fallback=False):
@@ -33,6 +78,7 @@ del handlers
 log_main = logging.getLogger('StreamProxy_main')
 log_head = logging.getLogger('StreamProxy_head')
 log_irre = logging.getLogger('StreamProxy_irre')
+log_up = logging.getLogger('StreamProxy_upstream')
 log_level = config.get('LOGGING', 'log_level', fallback='INFO').upper()
 if log_level == 'ALL':
     log_level = 0
@@ -41,196 +87,1220 @@ elif log_level == 'NORMAL':
 log_main.setLevel(log_level)
 log_head.setLevel(log_level)
 log_irre.setLevel(log_level)
+log_up.setLevel(log_level)
+for key in ['ttl', 'ttl_tolerance']:
+    if config.has_option('PROXY_SETTINGS', key):
+        log_main.warning('{0} counted transactions and is ignored, set {0}_seconds instead.'.format(key))
 
 client_modes = {}  # name: mode
-clients_head = {}  # name: [ 0: client_address  1: subscription (transfer, comment, ...)  2: ttl in tx]
-clients_irreversible = {}  # name: [ 0: client_address  1: subscription (transfer, comment, ...)  2: ttl in tx]
+# subs are op types (transfer, comment, ...) or filter dicts, see filters.py
+clients_head = {}  # name: [ 0: client_address  1: subs  2: deadline (monotonic time)  3: options]
+clients_irreversible = {}  # name: [ 0: client_address  1: subs  2: deadline (monotonic time)  3: options]
+subs_head = SubscriptionIndex()  # subscriptions of the clients in clients_head
+subs_irreversible = SubscriptionIndex()  # subscriptions of the clients in clients_irreversible
+batches = {}  # name: [ 0: encoded stream_data messages  1: size  2: time of the first message  3: its block_num
+#                4: handle of the timer flushing it after batch_window]
+sequences = {}  # name: [ 0: next sequence number  1: retransmit buffer {sequence number: sent message}]
+shm_clients = set()  # names of clients reading the ring of their mode, they are not in subs_head/subs_irreversible
+rings = {}  # mode: RingWriter every op of the mode is published to
+mc_clients = set()  # names of clients receiving the multicast groups of their mode, not in subs_head/subs_irreversible
+mc_sequences = {}  # (mode, group): [ 0: next sequence number  1: retransmit buffer {sequence number: sent message}]
+mc_socket = sender_socket(multicast_interface, multicast_ttl) if multicast else None
+block_clients = set()  # names of clients which get a block message after the ops of each block
+queues = {}  # name: deque of (block_num, sequence number, encoded message) waiting for the sender
+ready = deque()  # names of the clients with queued messages, in sending order
+skipped = {}  # name: [(block_num, sequence number)] dropped by slow_policy, reported once the queue is empty
+sender_task = None  # task of drain_queues()
+queued = None  # asyncio.Event set when a queue got its first message
+writable = None  # asyncio.Event cleared while the transport pauses writing
+metrics = Metrics()
+deadlines = []  # heap of (due time, name), one entry per client, see expire_clients()
+armed = {}  # name: due time of its entry in deadlines, older entries of the name are stale
+expiry_task = None  # task of expire_clients()
+backfilling = {}  # name: task of backfill() or replay_recent(), not in subs_head/subs_irreversible yet
+backfill_ranges = {}  # name: [next block number, end_block] of its running backfill or replay
+backfill_pool = ThreadPoolExecutor(max_workers=backfill_workers)
+live_position = {'head': None, 'irreversible': None}  # mode: number of the last block delivered live
+store = None  # BlockStore, opened by main() once a process handing over closed it
+upstream_task = None  # task of stream_upstream() while any client is registered
+transport = None  # datagram transport of the server socket, all client state is owned by its event loop
+running = True
+stopped = None  # asyncio.Event set by the stop command, a signal or a handover
+handed_over = False
+http_server = None  # server of the metrics if metrics_port is set
+snapshot_task = None  # task of snapshot_registry() if state_file is set
+handover_task = None  # task of wait_for_handover() if handover_socket is set
+shard_writers = []  # parent of workers: StreamWriter of the channel to each worker
+shard_tasks = []  # parent of workers: tasks of read_worker()
+shard_subs = {}  # parent of workers: worker number: union of the subscriptions of its clients
+shard_requests = {}  # parent of workers: request id: future of the answer of a worker
+shard_ids = itertools.count()
+worker_number = None  # number of this process if it is one of the workers
+
+
+class RecentBlocks:
+    """Ring buffer of the latest delivered blocks of one mode, limited in blocks and optionally in bytes."""
+
+    def __init__(self, max_blocks: int, max_bytes: int = 0):
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        self.blocks = deque()  # (block, encoded size of its ops)
+        self.size = 0
+
+    def append(self, block):
+        size = len(pickle.dumps(block['ops'])) if self.max_bytes else 0
+        self.blocks.append((block, size))
+        self.size += size
+        while len(self.blocks) > self.max_blocks or (self.max_bytes and self.size > self.max_bytes):
+            self.size -= self.blocks.popleft()[1]
+
+    def first_block_num(self):
+        return self.blocks[0][0]['block_num'] if self.blocks else None
+
+    def since(self, block_num: int):
+        return [block for block, _ in self.blocks if block['block_num'] >= block_num]
+
+
+recent_head = RecentBlocks(replay_buffer_blocks, replay_buffer_bytes)
+recent_irreversible = RecentBlocks(replay_buffer_blocks, replay_buffer_bytes)
+
+
+def index_subs(index, client_name, subs):
+    if client_name in shm_clients or client_name in mc_clients or client_name in backfilling:
+        return
+    index.add(client_name, subs)
+
+
+def unindex_subs(index, client_name, subs):
+    index.remove(client_name, subs)
+
+
+def subs_changed():
+    """Passes the union of the subscriptions of all clients to a block source which filters by them."""
+    if not hasattr(block_source, 'set_subs'):
+        return
+    union = {}
+    for subs in [client[1] for client in clients_head.values()] + \
+            [client[1] for client in clients_irreversible.values()] + list(shard_subs.values()):
+        for sub in subs:
+            union.setdefault(sub_key(sub), sub)
+    block_source.set_subs(list(union.values()))
+
+
+def collect_queues(metrics_):
+    for client_name, queue in queues.items():
+        metrics_.set('proxy_queue_depth', len(queue), client=client_name)
+    metrics_.set('proxy_clients', len(clients_head), mode='head')
+    metrics_.set('proxy_clients', len(clients_irreversible), mode='irreversible')
+
+
+def collect_nodes(metrics_):
+    for node in getattr(block_source, 'nodes', []):
+        metrics_.set('proxy_node_head', node.head, node=node.url)
+        if node.latency is not None:
+            metrics_.set('proxy_node_latency_seconds', round(node.latency, 6), node=node.url)
+    if hasattr(block_source, 'hedged'):
+        metrics_.set('proxy_hedged_requests', block_source.hedged)
+
+
+metrics.collectors.append(collect_queues)
+metrics.collectors.append(collect_nodes)
+
+
+def collect_store(metrics_):
+    if store is None:
+        return
+    metrics_.set('proxy_block_store_bytes', store.size())
+    metrics_.set('proxy_block_store_hits', store.hits)
+    metrics_.set('proxy_block_store_misses', store.misses)
+    metrics_.set('proxy_block_store_compactions', store.compactions)
+
+
+metrics.collectors.append(collect_store)
+
+
+def collect_shards(metrics_):
+    for number, writer in enumerate(shard_writers):
+        metrics_.set('proxy_shard_backlog_bytes', writer.transport.get_write_buffer_size(), worker=number)
+
+
+metrics.collectors.append(collect_shards)
+
+
+def block_age(block):
+    """Seconds since the block was produced, None if its timestamp is unknown."""
+    timestamp = block.get('timestamp')
+    if isinstance(timestamp, str):
+        try:
+            timestamp = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
+        except ValueError:
+            return None
+    if not isinstance(timestamp, datetime):
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return time.time() - timestamp.timestamp()
+
+
+def client_codec(client):
+    return CODECS[client[3]['codec']]
+
+
+def parse_fields(fields):
+    """Turns the fields option of a registration into {op type or '*': tuple of fields}, None keeps every field."""
+    if fields is None:
+        return None
+    if isinstance(fields, list):
+        fields = {'*': fields}
+    if not isinstance(fields, dict) or not all(isinstance(names, list) and all(isinstance(name, str) for name in names)
+                                               for names in fields.values()):
+        raise ValueError('fields must be a list of field names or a dict of op type: list of field names')
+    # trx_num orders the ops of a block in framing.BlockAssembler
+    return {op_type: tuple(sorted(set(names) | {'type', 'block_num', 'trx_num'})) for op_type, names in fields.items()}
+
+
+def projection(client, op_type):
+    fields = client[3]['fields']
+    if fields is None:
+        return None
+    return fields.get(op_type, fields.get('*'))
+
+
+def encode_op(client, tx, mode):
+    fields = projection(client, tx.get('type'))
+    if fields is not None:
+        tx = {field: tx[field] for field in fields if field in tx}
+    return client_codec(client).dumps({'data': tx, 'info': 'stream_data'}, mode)
+
+
+def send(payload, address, codec):
+    count = 0
+    for datagram in fragments(payload, max_datagram, codec):
+        transport.sendto(datagram, address)
+        count += 1
+    metrics.inc('proxy_sent_datagrams_total', count)
+
+
+def delete_client(client_name):
+    """Tells a client it was deleted and forgets all of its state."""
+    if client_modes[client_name] == 'head':
+        clients, index = clients_head, subs_head
+    else:
+        clients, index = clients_irreversible, subs_irreversible
+    client = clients.pop(client_name)
+    transport.sendto(client_codec(client).dumps({'info': 'client_delete', 'name': client_name}), client[0])
+    unindex_subs(index, client_name, client[1])
+    batch = batches.pop(client_name, None)
+    if batch and batch[4] is not None:
+        batch[4].cancel()
+    sequences.pop(client_name, None)
+    queues.pop(client_name, None)
+    skipped.pop(client_name, None)
+    shm_clients.discard(client_name)
+    mc_clients.discard(client_name)
+    block_clients.discard(client_name)
+    armed.pop(client_name, None)
+    task = backfilling.pop(client_name, None)
+    if task is not None:
+        task.cancel()
+    backfill_ranges.pop(client_name, None)
+    del client_modes[client_name]
+    metrics.forget(client=client_name)
+    subs_changed()
 
 
-def stream_head():
-    last_block = 0
-    log_head.info('starting thread "head"')
-    for tx in Blockchain(mode='head').stream():
-        log_head.log(5, tx)
-        if not running:
+def arm(client_name, due):
+    armed[client_name] = due
+    heapq.heappush(deadlines, (due, client_name))
+
+
+async def expire_clients():
+    """Expires clients whose deadline passed without a refresh.
+
+    A refresh only moves the deadline of the client, its heap entry is re-armed when it comes due. A client past its
+    deadline gets a single refresh_req and is deleted ttl_tolerance_seconds later if it still does not refresh, so the
+    work depends on the number of due entries, not on the number of clients.
+    """
+    while True:
+        now = time.monotonic()
+        while deadlines and deadlines[0][0] <= now:
+            due, client_name = heapq.heappop(deadlines)
+            if armed.get(client_name) != due:
+                continue
+            client = clients_head.get(client_name) or clients_irreversible.get(client_name)
+            if client[2] > now:
+                arm(client_name, client[2])
+            elif now < client[2] + ttl_tolerance:
+                transport.sendto(client_codec(client).dumps({'info': 'refresh_req', 'name': client_name}), client[0])
+                arm(client_name, client[2] + ttl_tolerance)
+            else:
+                log_main.info('Deleting client "{}", it did not refresh.'.format(client_name))
+                metrics.inc('proxy_ttl_evictions_total', mode=client_modes[client_name])
+                delete_client(client_name)
+        await asyncio.sleep(min(1, deadlines[0][0] - now) if deadlines else 1)
+
+
+def summary_message(client_name, client, dropped):
+    """stream_summary of dropped messages given as (block_num, sequence number, ...), the client does not NACK them."""
+    blocks = [entry[0] for entry in dropped if entry[0] is not None]
+    summary = {'messages': len(dropped), 'first_block': min(blocks, default=None),
+               'last_block': max(blocks, default=None),
+               'seqs': seq_ranges(entry[1] for entry in dropped if entry[1] is not None)}
+    return client_codec(client).dumps({'info': 'stream_summary', 'name': client_name, 'data': summary})
+
+
+def coalesce(client_name, client, queue):
+    """Replaces the queued messages of a client by one stream_summary of what was dropped."""
+    message = summary_message(client_name, client, queue)
+    queue.clear()
+    queue.append((None, None, message))
+
+
+def skip(client_name, block_num, seq):
+    """Forgets a dropped message, so a NACK for it is answered with nack_lost instead of queueing it again."""
+    sequence = sequences.get(client_name)
+    if sequence is not None and seq is not None:
+        sequence[1].pop(seq, None)
+    skipped.setdefault(client_name, []).append((block_num, seq))
+
+
+def enqueue(client_name, client, message, block_num=None, seq=None):
+    """Queues an encoded message for the sender, applying slow_policy if the queue of the client is full."""
+    if client_name not in client_modes:  # evicted while a block was delivered to it
+        return
+    queue = queues.get(client_name)
+    if queue is None:
+        queue = queues[client_name] = deque()
+    if not queue:
+        ready.append(client_name)
+        queued.set()
+    elif len(queue) >= send_queue:
+        if slow_policy == 'evict':
+            log_main.warning('Evicting client "{}", its send queue is full.'.format(client_name))
+            metrics.inc('proxy_slow_evictions_total', mode=client_modes[client_name])
+            delete_client(client_name)
             return
+        if slow_policy == 'drop_newest':
+            client[3]['dropped'] += 1
+            metrics.inc('proxy_dropped_messages_total', mode=client_modes[client_name])
+            skip(client_name, block_num, seq)
+            return
+        if slow_policy == 'drop_oldest':
+            skip(client_name, *queue.popleft()[:2])
+            client[3]['dropped'] += 1
+            metrics.inc('proxy_dropped_messages_total', mode=client_modes[client_name])
+        else:
+            client[3]['dropped'] += len(queue)
+            metrics.inc('proxy_dropped_messages_total', len(queue), mode=client_modes[client_name])
+            coalesce(client_name, client, queue)
+    queue.append((block_num, seq, message))
+
+
+async def drain_queues():
+    """Sends the queued messages round robin, a few per client at a time, so a slow client delays nobody else."""
+    while True:
+        if not ready:
+            queued.clear()
+            await queued.wait()
+            continue
+        await writable.wait()
+        client_name = ready.popleft()
+        queue = queues.get(client_name)
+        client = clients_head.get(client_name) or clients_irreversible.get(client_name)
+        if not queue or client is None:
+            continue
+        count = min(len(queue), 16)
+        size = 0
+        for _ in range(count):
+            message = queue.popleft()[2]
+            send(message, client[0], client_codec(client))
+            size += len(message)
+        metrics.inc('proxy_sent_messages_total', count, client=client_name)
+        metrics.inc('proxy_sent_bytes_total', size, client=client_name)
+        metrics.inc('proxy_sent_bytes_total', size, mode=client_modes[client_name])
+        if queue:
+            ready.append(client_name)
+        elif client_name in skipped:  # everything sent before is out, the client can skip the dropped ones
+            send(summary_message(client_name, client, skipped.pop(client_name)), client[0], client_codec(client))
+        await asyncio.sleep(0)  # lets the upstream and the commands in between
+
+
+def send_sequenced(client_name, client, payload, block_num=None):
+    """Queues a data message, numbered and kept for retransmission if the client asked for sequence numbers."""
+    sequence = sequences.get(client_name)
+    if sequence is None:
+        enqueue(client_name, client, payload, block_num)
+        return
+    message = client_codec(client).dumps({'info': 'sequenced', 'seq': sequence[0], 'data': payload})
+    sequence[1][sequence[0]] = message
+    if len(sequence[1]) > retransmit_buffer:
+        sequence[1].popitem(last=False)
+    sequence[0] += 1
+    enqueue(client_name, client, message, block_num, sequence[0] - 1)
+
+
+def retransmit(client_name, client, ranges, group=None):
+    """Answers a NACK from the retransmit buffer, reports the sequence numbers which are not buffered any more.
+
+    With group the NACK is about the messages of that multicast group of the client's mode, they are sent again by
+    unicast.
+    """
+    if group is None:
+        sequence, limit = sequences.get(client_name), retransmit_buffer
+    else:
+        sequence, limit = mc_sequences.get((client_modes[client_name], group)), multicast_buffer
+    lost = []
+    for start, end in ranges:
+        for seq in range(start, min(end, start + limit) + 1):
+            message = sequence[1].get(seq) if sequence else None
+            if message is None:
+                lost.append(seq)
+            else:
+                enqueue(client_name, client, message, None, seq if group is None else None)  # not the client's seqs
+                client[3]['retransmitted'] += 1
+    if lost:
+        client[3]['unrecoverable'] += len(lost)
+        message = {'info': 'nack_lost', 'name': client_name, 'data': lost}
+        if group is not None:
+            message['group'] = group
+        send(client_codec(client).dumps(message), client[0], client_codec(client))
+    log_main.debug('Retransmitted to client "{}", {} lost.'.format(client_name, len(lost)))
+
+
+def flush_batch(client_name, client):
+    batch = batches.pop(client_name, None)
+    if not batch:
+        return
+    if batch[4] is not None:
+        batch[4].cancel()
+    if len(batch[0]) == 1:
+        send_sequenced(client_name, client, batch[0][0], batch[3])
+    else:
+        send_sequenced(client_name, client, client_codec(client).dumps({'info': 'stream_batch', 'data': batch[0]}),
+                       batch[3])
+
+
+def flush_batches(clients):
+    now = time.monotonic()
+    for client_name in [x for x in batches if x in clients]:
+        if not batch_window or now - batches[client_name][2] >= batch_window:
+            flush_batch(client_name, clients[client_name])
+
+
+def flush_batch_later(client_name):
+    """Flushes a batch once its window passed, also if no further op arrives for the client."""
+    clients = clients_head if client_modes.get(client_name) == 'head' else clients_irreversible
+    if client_name in batches and client_name in clients:
+        batches[client_name][4] = None
+        flush_batch(client_name, clients[client_name])
+
+
+def registered(client_name, client):
+    """Whether the client is still registered, slow_policy evict deletes clients while messages are queued."""
+    clients = clients_head if client_modes.get(client_name) == 'head' else clients_irreversible
+    return clients.get(client_name) is client
+
+
+def send_data(client_name, client, payload, block_num=None):
+    """Sends an encoded stream_data message, or packs it into the pending batch of the client."""
+    if not client[3].get('batch'):
+        send_sequenced(client_name, client, payload, block_num)
+        return
+    batch = batches.get(client_name)
+    if batch and batch[1] + len(payload) > batch_size:
+        flush_batch(client_name, client)
+        batch = None
+    if batch is None:
+        if not registered(client_name, client):  # evicted by the flush, no batch or timer may outlive it
+            return
+        batch = batches[client_name] = [[], 64, time.monotonic(), block_num, None]  # 64 bytes for the message
+        if batch_window:
+            batch[4] = asyncio.get_running_loop().call_later(batch_window, flush_batch_later, client_name)
+    batch[0].append(payload)
+    batch[1] += len(payload) + 8
+    if batch_window and time.monotonic() - batch[2] >= batch_window:
+        flush_batch(client_name, client)
+
+
+def fan_out(tx, mode, clients, index, log):
+    names = index.match(tx)
+    if not names:
+        return
+    # (codec name, projected fields): encoded message, clients sharing both share the encoding of the op
+    payloads = {}
+    log.log(15, 'Sending %s to %d client(s)', tx.get('type'), len(names))
+    for client_name in names:
+        client = clients.get(client_name)
+        if client:
+            key = client[3]['codec'], projection(client, tx.get('type'))
+            payload = payloads.get(key)
+            if payload is None:
+                payload = payloads[key] = encode_op(client, tx, mode)
+            send_data(client_name, client, payload, tx.get('block_num'))
+
+
+def send_multicast(op_type, payload, mode):
+    """Sends an encoded op once to the group of its type, numbered per group so clients can NACK missing ones."""
+    group = group_index(op_type, multicast_groups)
+    sequence = mc_sequences.setdefault((mode, group), [0, OrderedDict()])
+    address = group_addresses(multicast_group, mode, multicast_groups)[group], multicast_port
+    for part in fragments(payload, max_datagram, ring_codec):
+        message = ring_codec.dumps({'info': 'multicast', 'mode': mode, 'group': group, 'seq': sequence[0],
+                                    'data': part}, mode)
+        sequence[1][sequence[0]] = message
+        if len(sequence[1]) > multicast_buffer:
+            sequence[1].popitem(last=False)
+        sequence[0] += 1
+        try:
+            mc_socket.sendto(message, address)
+        except OSError:  # the send buffer is full, the clients NACK the message
+            metrics.inc('proxy_multicast_errors_total', mode=mode)
+            continue
+        metrics.inc('proxy_multicast_messages_total', mode=mode)
+        metrics.inc('proxy_multicast_bytes_total', len(message), mode=mode)
+
+
+def publish_block(block, mode):
+    """Publishes every op of the block once to the ring and the multicast groups of the mode, if enabled."""
+    ring = rings.get(mode)
+    if ring is None and mc_socket is None:
+        return
+    for tx in block['ops']:
+        payload = ring_codec.dumps({'data': tx, 'info': 'stream_data'}, mode)
+        if ring is not None:
+            try:
+                ring.write(tx.get('type', ''), payload)
+            except ValueError as e:
+                log_main.warning('Could not publish op to the ring: {!s}'.format(e))
+        if mc_socket is not None:
+            send_multicast(tx.get('type', ''), payload, mode)
+
+
+def send_block(client_name, client, block, mode):
+    """Tells a client that all ops of the block matching its subscriptions were sent, and how many."""
+    flush_batch(client_name, client)
+    header = {key: block.get(key) for key in BLOCK_FIELDS}
+    header['count'] = sum(1 for tx in block['ops'] if matches_any(client[1], tx))
+    send_sequenced(client_name, client, client_codec(client).dumps({'info': 'block', 'data': header}, mode),
+                   block['block_num'])
+
+
+def deliver_block(block, mode, clients, index, log):
+    log.log(5, block)
+    start = time.monotonic()
+    age = block_age(block)
+    if age is not None:
+        metrics.observe('proxy_block_age_seconds', age, mode=mode)
+    for tx in block['ops']:
+        fan_out(tx, mode, clients, index, log)
+    flush_batches(clients)
+    for client_name in list(block_clients):  # evict deletes clients from it
+        client = clients.get(client_name)
+        if client is not None and client_name not in backfilling:
+            send_block(client_name, client, block, mode)
+    metrics.inc('proxy_blocks_total', mode=mode)
+    metrics.inc('proxy_ops_total', len(block['ops']), mode=mode)
+    metrics.observe('proxy_fan_out_seconds', time.monotonic() - start, mode=mode)
 
-        if last_block != tx['block_num']:
-            last_block = tx['block_num']
-            delete_list = []
-            for client_name in clients_head.keys():
-                clients_head[client_name][2] -= 1
-                if clients_head[client_name][2] <= -ttl_tolerance:
-                    delete_list.append(client_name)
-                if clients_head[client_name][2] <= 0:
-                    myself.sendto(pickle.dumps({'info': 'refresh_req', 'name': client_name}),
-                                  clients_head[client_name][0])
-            for client_name in delete_list:
-                myself.sendto(pickle.dumps({'info': 'client_delete', 'name': client_name}),
-                              clients_head[client_name][0])
-                del clients_head[client_name]
-                del client_modes[client_name]
-
-            if not len(clients_head):
-                log_head.info('stopping thread "head"')
+
+async def replay_recent(client_name, from_block):
+    """Sends the buffered ops since from_block which match the subscriptions of the client, then indexes it.
+
+    Like a backfill the blocks are sent only while the send queue of the client is at most half full, and the client
+    joins live delivery in the same step of the event loop in which it caught up with the buffer.
+    """
+    mode = client_modes[client_name]
+    clients, index, recent = (clients_head, subs_head, recent_head) if mode == 'head' else \
+        (clients_irreversible, subs_irreversible, recent_irreversible)
+    client = clients[client_name]
+    first = recent.first_block_num()
+    if first is not None and first > from_block:
+        transport.sendto(client_codec(client).dumps({'info': 'error', 'name': client_name,
+                                                     'data': 'blocks before {!s} are not buffered'.format(first)}),
+                         client[0])
+    block_num = from_block
+    backfill_ranges[client_name] = [block_num, None]  # a restored registry backfills the rest
+    count = 0
+    while True:
+        blocks = recent.since(block_num)
+        if not blocks:
+            break
+        if blocks[0]['block_num'] > block_num > from_block:
+            log_main.warning('Blocks {} to {} left the buffer during the replay to client "{}".'.format(
+                block_num, blocks[0]['block_num'] - 1, client_name))
+        for block in blocks:
+            client = clients[client_name]
+            for tx in block['ops']:
+                if matches_any(client[1], tx):
+                    send_data(client_name, client, encode_op(client, tx, mode), block['block_num'])
+                    count += 1
+            if client_name in block_clients:
+                send_block(client_name, client, block, mode)
+            else:
+                flush_batch(client_name, client)
+            if not registered(client_name, client):  # evicted, delete_client forgot the replay
                 return
+            block_num = block['block_num'] + 1
+            backfill_ranges[client_name][0] = block_num
+            while len(queues.get(client_name, ())) > send_queue // 2:
+                await asyncio.sleep(0.01)
+    del backfilling[client_name]
+    del backfill_ranges[client_name]
+    index_subs(index, client_name, clients[client_name][1])
+    log_main.info('Replayed {} ops since block {} to client "{}".'.format(count, from_block, client_name))
+
+
+def valid_backfill(data_):
+    start, end = data_.get('start_block'), data_.get('end_block')
+    if end is None:
+        end = start
+    return isinstance(start, int) and isinstance(end, int) and start <= end \
+        and data_.get('transport', 'udp') == 'udp'
+
+
+async def backfill(client_name, start_block, end_block):
+    """Sends the matching ops of the blocks from start_block on, then hands the client over to live delivery.
+
+    backfill_workers threads fetch the blocks ahead, they are delivered in order and only while the send queue of the
+    client is at most half full. Without end_block the client gets indexed for live delivery in the same step of the
+    event loop in which it caught up with the last block delivered live, so no block is missed or sent twice. An
+    end_block after the last block delivered live is waited for.
+    """
+    loop = asyncio.get_running_loop()
+    mode = client_modes[client_name]
+    clients, index = (clients_head, subs_head) if mode == 'head' else (clients_irreversible, subs_irreversible)
+    fetching = {}  # block_num: future of stored_block
+    block_num = start_block
+    backfill_ranges[client_name] = [block_num, end_block]
+    log_main.info('Backfilling client "{}" from block {}.'.format(client_name, start_block))
+    try:
+        while True:
+            if live_position[mode] is None:  # upstream did not deliver its first block yet
+                await asyncio.sleep(0.1)
+                continue
+            target = live_position[mode] if end_block is None else min(end_block, live_position[mode])
+            if block_num > target:
+                if end_block is None or block_num > end_block:
+                    break
+                await asyncio.sleep(0.1)  # end_block was not delivered live yet
+                continue
+            for number in range(block_num, min(target, block_num + 2 * backfill_workers - 1) + 1):
+                if number not in fetching:
+                    fetching[number] = loop.run_in_executor(backfill_pool, stored_block, number)
+            try:
+                block = await fetching.pop(block_num)
+            except Exception as e:
+                log_main.warning('Backfill of block {} failed: {!r}'.format(block_num, e))
+                block = None
+            client = clients[client_name]
+            if block is None:
+                log_main.warning('Block {} is not available, skipping it in the backfill.'.format(block_num))
+            else:
+                for tx in block['ops']:
+                    if matches_any(client[1], tx):
+                        send_data(client_name, client, encode_op(client, tx, mode), block_num)
+                if client_name in block_clients:
+                    send_block(client_name, client, block, mode)
+                else:
+                    flush_batch(client_name, client)
+                metrics.inc('proxy_backfill_blocks_total', mode=mode)
+                if not registered(client_name, client):  # evicted, delete_client forgot the backfill
+                    return
+            block_num += 1
+            backfill_ranges[client_name][0] = block_num
+            while len(queues.get(client_name, ())) > send_queue // 2:
+                await asyncio.sleep(0.01)
+    finally:
+        for future in fetching.values():
+            future.cancel()
+
+    del backfilling[client_name]
+    del backfill_ranges[client_name]
+    client = clients[client_name]
+    if end_block is None:
+        index_subs(index, client_name, client[1])
+    done = {'last_block': block_num - 1, 'live': end_block is None}
+    send_sequenced(client_name, client, client_codec(client).dumps({'info': 'backfill_done', 'name': client_name,
+                                                                    'data': done}))
+    log_main.info('Backfilled client "{}" up to block {}.'.format(client_name, block_num - 1))
+    if end_block is not None:  # nothing follows, forgets the client once the sender is done with it
+        while queues.get(client_name) and clients.get(client_name) is client:
+            await asyncio.sleep(0.01)
+        if clients.get(client_name) is client:
+            delete_client(client_name)
+            log_main.info('Deleted client "{}" after its backfill.'.format(client_name))
+
 
-        for client_name in copy(clients_head).keys():
-            if tx.get('type') in clients_head[client_name][1]:
-                log_head.log(15, 'Sending {} to "{}" ({!s})'.format(tx.get('type'), client_name,
-                                                                    clients_head[client_name][2]))
-                myself.sendto(pickle.dumps({'data': tx, 'name': client_name, 'info': 'stream_data'}),
-                              clients_head[client_name][0])
+def stored_block(block_num):
+    """The block from the block store if it has it, else from the block source; irreversible blocks get stored."""
+    if store is None:
+        return block_source.get_block(block_num)
+    block = store.get(block_num)
+    if block is None:
+        block = block_source.get_block(block_num)
+        if block is not None and block_num <= block.get('irreversible_block_num', -1):
+            store.put(block)
+    return block
 
 
-def stream_irreversible():
-    last_block = 0
-    log_irre.info('starting thread "irreversible"')
-    for tx in Blockchain(mode='irreversible').stream():
-        log_irre.log(5, tx)
-        if not running:
+async def fetch_block(block_num, stored=True):
+    """Fetches a block in the default executor, with stored=False always from the block source."""
+    start = time.monotonic()
+    block = await asyncio.get_running_loop().run_in_executor(None, stored_block if stored else block_source.get_block,
+                                                             block_num)
+    metrics.observe('proxy_upstream_fetch_seconds', time.monotonic() - start, call='get_block')
+    return block
+
+
+async def repair_fork(pending, block):
+    """Replaces buffered blocks which are not ancestors of block any more."""
+    block_num = block['block_num'] - 1
+    previous_id = block['previous']
+    while block_num in pending and pending[block_num]['block_id'] != previous_id:
+        replacement = await fetch_block(block_num, stored=False)
+        if replacement is None:
+            log_up.warning('Dropping reorganized block {}.'.format(block_num))
+            del pending[block_num]
             return
+        log_up.warning('Replacing reorganized block {}.'.format(block_num))
+        pending[block_num] = replacement
+        previous_id = replacement['previous']
+        block_num -= 1
+
 
-        if last_block != tx['block_num']:
-            last_block = tx['block_num']
-            delete_list = []
-            for client_name in clients_irreversible.keys():
-                clients_irreversible[client_name][2] -= 1
-                if clients_irreversible[client_name][2] <= -ttl_tolerance:
-                    delete_list.append(client_name)
-                if clients_irreversible[client_name][2] <= 0:
-                    myself.sendto(pickle.dumps({'info': 'refresh_req', 'name': client_name}),
-                                  clients_irreversible[client_name][0])
-            for client_name in delete_list:
-                myself.sendto(pickle.dumps({'info': 'client_delete', 'name': client_name}),
-                              clients_irreversible[client_name][0])
-                del clients_irreversible[client_name]
-                del client_modes[client_name]
-            if not len(clients_irreversible):
-                log_irre.info('stopping thread "irreversible"')
+async def stream_upstream():
+    """Streams head blocks once and serves both modes, irreversible ones from the buffer of pending blocks.
+
+    The block source blocks, so each block is fetched in the default executor while the event loop keeps serving
+    commands. If the source or the delivery of a block fails, the error is logged and the source is started again
+    after upstream_retry seconds, the pending blocks are kept.
+    """
+    loop = asyncio.get_running_loop()
+    blocks = None
+    pending = {}  # block_num: head block which is not irreversible yet
+    next_irreversible = None
+    log_up.info('starting task "upstream"')
+    while True:
+        try:
+            if blocks is None:
+                blocks = block_source.blocks()
+            start = time.monotonic()
+            block = await loop.run_in_executor(None, next, blocks, None)
+            if block is None or not running:
                 return
+            metrics.observe('proxy_upstream_fetch_seconds', time.monotonic() - start, call='blocks')
+
+            block_num = block['block_num']
+            if block.get('previous') and block_num - 1 in pending \
+                    and pending[block_num - 1]['block_id'] != block['previous']:
+                await repair_fork(pending, block)
+            pending[block_num] = block
+
+            if clients_head:
+                deliver_block(block, 'head', clients_head, subs_head, log_head)
+                publish_block(block, 'head')
+            if shard_writers:
+                forward_block(block)
+            recent_head.append(block)
+            live_position['head'] = block_num
+
+            if next_irreversible is None:
+                next_irreversible = block['irreversible_block_num']
+            while next_irreversible <= block['irreversible_block_num']:
+                final = pending.pop(next_irreversible, None)
+                if final is not None and store is not None:  # only final blocks, a fork may still replace the others
+                    loop.run_in_executor(None, store.put, final)
+                if clients_irreversible and final is None:
+                    final = await fetch_block(next_irreversible)
+                if final is None:
+                    if clients_irreversible:
+                        log_irre.warning('Block {} is not available, skipping it.'.format(next_irreversible))
+                else:
+                    if clients_irreversible:
+                        deliver_block(final, 'irreversible', clients_irreversible, subs_irreversible, log_irre)
+                        publish_block(final, 'irreversible')
+                    recent_irreversible.append(final)
+                live_position['irreversible'] = next_irreversible
+                next_irreversible += 1
+        except Exception:
+            log_up.exception('Upstream failed, restarting the block source in {}s.'.format(upstream_retry))
+            metrics.inc('proxy_upstream_errors_total')
+            if blocks is not None:
+                blocks.close()
+            blocks = None
+            await asyncio.sleep(upstream_retry)
+
+        if not clients_head and not clients_irreversible and not shard_writers:
+            log_up.info('stopping task "upstream"')
+            return
+
+
+def forward_block(block):
+    """Hands a head block to every worker, pickled once; the workers deliver both modes themselves.
+
+    A worker with more than worker_backlog bytes not read yet does not get the block, it asks for the irreversible
+    blocks it misses like for any other.
+    """
+    message = frame(('block', block))
+    for number, writer in enumerate(shard_writers):
+        if writer.transport.get_write_buffer_size() > shard_backlog:
+            log_main.warning('Worker {} is behind, not forwarding block {} to it.'.format(number, block['block_num']))
+            metrics.inc('proxy_shard_dropped_blocks_total', worker=number)
+            continue
+        writer.write(message)
+    metrics.inc('proxy_forwarded_blocks_total')
+
+
+async def answer_block(number, request_id, block_num):
+    try:
+        block = await fetch_block(block_num)
+    except Exception as e:
+        log_up.warning('Could not fetch block {} for worker {}: {!r}'.format(block_num, number, e))
+        block = None
+    shard_writers[number].write(frame(('block_reply', request_id, block)))
+
+
+async def read_worker(number, reader):
+    """Serves the requests of a worker; the proxy stops if the worker ends, its clients would not be served."""
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await read_frame(reader)
+        if message is None:
+            if running:
+                log_main.error('Worker {} ended, stopping.'.format(number))
+                stopped.set()
+            return
+        if message[0] == 'get_block':
+            loop.create_task(answer_block(number, message[1], message[2]))
+        elif message[0] == 'stats_reply':
+            future = shard_requests.pop(message[1], None)
+            if future is not None and not future.done():
+                future.set_result(message[2])
+        elif message[0] == 'subs':
+            shard_subs[number] = message[1]
+            subs_changed()
+
+
+async def answer_stats(address_, codec_):
+    """Sends the metrics of the parent and, labelled with worker, those of the workers answering within a second."""
+    loop = asyncio.get_running_loop()
+    futures = []
+    for writer in shard_writers:
+        request_id = next(shard_ids)
+        future = shard_requests[request_id] = loop.create_future()
+        writer.write(frame(('stats', request_id)))
+        futures.append((request_id, future))
+    await asyncio.wait([future for _, future in futures], timeout=1)
+    snapshot = metrics.snapshot()
+    for number, (request_id, future) in enumerate(futures):
+        shard_requests.pop(request_id, None)
+        if future.done():
+            merge_snapshot(snapshot, future.result(), worker=number)
+    send(codec_.dumps({'info': 'stats', 'data': snapshot}), address_, codec_)
+
+
+async def read_parent(reader, writer, protocol):
+    """Takes the blocks, the datagrams of the clients of this worker and the answers the parent sends."""
+    while True:
+        message = await read_frame(reader)
+        if message is None or message[0] == 'exit':
+            stopped.set()
+            return
+        if message[0] == 'block':
+            block_source.feed(message[1])
+        elif message[0] == 'datagram':
+            protocol.datagram_received(message[2], message[1])
+        elif message[0] == 'block_reply':
+            block_source.answer(message[1], message[2])
+        elif message[0] == 'stats':
+            writer.write(frame(('stats_reply', message[1], metrics.snapshot())))
+
+
+def start_upstream():
+    global upstream_task
+    if upstream_task is None or upstream_task.done():
+        upstream_task = asyncio.get_running_loop().create_task(stream_upstream())
+        upstream_task.add_done_callback(upstream_done)
+
+
+def upstream_done(task):
+    """Logs an upstream task which ended by an error and starts it again while clients wait for blocks."""
+    if task.cancelled() or task.exception() is None:
+        return
+    log_up.error('Task "upstream" failed.', exc_info=task.exception())
+    if running and (clients_head or clients_irreversible or shard_writers):
+        asyncio.get_running_loop().call_later(upstream_retry, start_upstream)
+
+
+def registry_state(full=False):
+    """What another proxy process needs to go on serving the registered clients.
+
+    With full the queued messages and the retransmit buffers are included as well, for a handover.
+    """
+    clients = {}
+    for client_name, mode in client_modes.items():
+        client = clients_head[client_name] if mode == 'head' else clients_irreversible[client_name]
+        saved = clients[client_name] = {
+            'mode': mode, 'address': client[0], 'subs': client[1], 'options': client[3],
+            'transport': 'shm' if client_name in shm_clients else 'multicast' if client_name in mc_clients else 'udp',
+            'backfill': backfill_ranges.get(client_name),
+            'seq': sequences[client_name][0] if client_name in sequences else None}
+        if full:
+            saved['retransmit'] = sequences[client_name][1] if client_name in sequences else None
+            saved['queue'] = list(queues.get(client_name, ()))
+    return {'time': time.time(), 'live_position': dict(live_position), 'clients': clients,
+            'multicast': {key: [sequence[0], sequence[1] if full else OrderedDict()]
+                          for key, sequence in mc_sequences.items()}}
+
+
+def restore_registry(state):
+    """Registers the clients of a snapshot or handover again, they resume without registering themselves.
+
+    UDP clients get the blocks delivered since the last one the previous process delivered live by a backfill, clients
+    of the shared memory transport are told the path of the new ring.
+    """
+    live = state['live_position']
+    for client_name, saved in state['clients'].items():
+        mode = saved['mode']
+        clients, index = (clients_head, subs_head) if mode == 'head' else (clients_irreversible, subs_irreversible)
+        client = clients[client_name] = [saved['address'], list(saved['subs']), time.monotonic() + standard_ttl,
+                                         saved['options']]
+        client_modes[client_name] = mode
+        arm(client_name, client[2])
+        if saved['seq'] is not None:
+            sequences[client_name] = [saved['seq'], saved.get('retransmit') or OrderedDict()]
+        if saved.get('queue'):
+            queues[client_name] = deque(saved['queue'])
+            ready.append(client_name)
+            queued.set()
+        if saved['transport'] == 'shm' and mode in rings:
+            shm_clients.add(client_name)
+            transport.sendto(client_codec(client).dumps({'info': 'shm_ring', 'name': client_name,
+                                                         'codec': ring_codec.name, 'data': rings[mode].path}),
+                             client[0])
+        elif saved['transport'] == 'multicast' and mc_socket is not None:
+            mc_clients.add(client_name)
+        if saved['options'].get('blocks'):
+            block_clients.add(client_name)
+        backfill_range = saved['backfill']
+        if backfill_range is None and client_name not in shm_clients and client_name not in mc_clients \
+                and live[mode] is not None:
+            backfill_range = [live[mode] + 1, None]
+        if backfill_range is not None:
+            backfilling[client_name] = asyncio.get_running_loop().create_task(backfill(client_name, *backfill_range))
+        index_subs(index, client_name, client[1])
+    mc_sequences.update((key, [sequence[0], sequence[1]]) for key, sequence in state['multicast'].items())
+    subs_changed()
+    if client_modes:
+        start_upstream()
+    log_main.info('Restored {} clients from {}.'.format(len(state['clients']),
+                                                       datetime.fromtimestamp(state['time']).isoformat()))
 
-        for client_name in copy(clients_irreversible).keys():
-            if tx.get('type') in clients_irreversible[client_name][1]:
-                log_irre.log(15, 'Sending {} to "{}" ({!s})'.format(tx.get('type'), client_name,
-                                                                    clients_irreversible[client_name][2]))
-                myself.sendto(pickle.dumps({'data': tx, 'name': client_name, 'info': 'stream_data'}),
-                              clients_irreversible[client_name][0])
 
+def write_state():
+    with open(state_file + '.tmp', 'wb') as file:
+        pickle.dump(registry_state(), file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(state_file + '.tmp', state_file)
 
-def execute_cmd(data_, address_):
+
+def read_state():
+    if not state_file or not os.path.exists(state_file):
+        return None
+    try:
+        with open(state_file, 'rb') as file:
+            return pickle.load(file)
+    except Exception as e:
+        log_main.warning('Could not read the snapshot {}: {!r}'.format(state_file, e))
+        return None
+
+
+async def snapshot_registry():
+    while True:
+        await asyncio.sleep(state_interval)
+        try:
+            write_state()
+        except OSError as e:
+            log_main.warning('Could not write the snapshot {}: {!s}'.format(state_file, e))
+
+
+def take_over():
+    """Asks a running proxy at handover_socket for its server socket and registry, (None, None) if there is none."""
+    if not handover_socket or not os.path.exists(handover_socket):
+        return None, None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(handover_socket)
+        header, fds, _, _ = socket.recv_fds(connection, 8, 1)
+        if not fds:
+            raise ConnectionError('no socket received')
+        length = struct.unpack('<Q', header)[0]
+        chunks = []
+        while length:
+            chunk = connection.recv(min(length, 1 << 20))
+            if not chunk:
+                raise ConnectionError('handover ended early')
+            chunks.append(chunk)
+            length -= len(chunk)
+    except OSError as e:
+        log_main.info('No proxy to take over at {} ({!s}).'.format(handover_socket, e))
+        return None, None
+    finally:
+        connection.close()
+    log_main.info('Took over the server socket.')
+    return socket.socket(fileno=fds[0]), pickle.loads(b''.join(chunks))
+
+
+async def wait_for_handover():
+    """Hands the server socket and the registry over to the next process connecting to handover_socket.
+
+    The socket stays bound the whole time, datagrams arriving meanwhile wait in its buffer for the new process.
+    """
+    global running, handed_over
+    loop = asyncio.get_running_loop()
+    if os.path.exists(handover_socket):
+        os.remove(handover_socket)  # left behind by a crashed process
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(handover_socket)
+    listener.listen(1)
+    listener.setblocking(False)
+    try:
+        connection, _ = await loop.sock_accept(listener)
+    finally:
+        listener.close()
+        os.remove(handover_socket)
+    log_main.info('Handing over to a new process.')
+    running = False
+    for client_name in list(batches):
+        flush_batch(client_name, (clients_head if client_modes[client_name] == 'head' else
+                                  clients_irreversible)[client_name])
+    state = pickle.dumps(registry_state(full=True), protocol=pickle.HIGHEST_PROTOCOL)
+    fd = os.dup(transport.get_extra_info('socket').fileno())
+    transport.close()  # stops reading right away, so the state is complete
+    release()
+    try:
+        socket.send_fds(connection, [struct.pack('<Q', len(state))], [fd])
+        await loop.sock_sendall(connection, state)
+    finally:
+        connection.close()
+        os.close(fd)
+    handed_over = True
+    stopped.set()
+
+
+def release():
+    """Stops the tasks and frees the rings, the block store and the ports, all but the server socket."""
+    for task in [upstream_task, sender_task, expiry_task, snapshot_task] + list(backfilling.values()):
+        if task is not None:
+            task.cancel()
+    if handover_task is not None and handover_task is not asyncio.current_task():
+        handover_task.cancel()
+    if http_server is not None:
+        http_server.close()
+    for ring in rings.values():
+        ring.close()
+    rings.clear()
+    if mc_socket is not None:
+        mc_socket.close()
+    backfill_pool.shutdown(wait=False, cancel_futures=True)
+    if store is not None:
+        store.close()
+    if hasattr(block_source, 'close'):
+        block_source.close()  # ends a blocks() waiting in an executor thread
+
+
+def client_options(data_, codec_):
+    """Options given at registration together with the delivery counters of the client."""
+    return {'batch': bool(data_.get('batch')), 'sequenced': bool(data_.get('sequenced')),
+            'blocks': bool(data_.get('blocks')),
+            'codec': data_['codec'] if data_.get('codec') in CODECS else codec_.name,
+            'fields': parse_fields(data_.get('fields')),
+            'retransmitted': 0, 'unrecoverable': 0, 'dropped': 0}
+
+
+def execute_cmd(data_, address_, codec_=CODECS['pickle']):
     log_main.debug(data_)
+    if data_.get('command') in ['set_subs', 'add_subs', 'rem_subs'] and data_.get('subs'):
+        try:
+            check_subs(data_['subs'])
+        except ValueError as e:
+            transport.sendto(codec_.dumps({'info': 'error', 'name': data_.get('name'), 'data': str(e)}), address_)
+            log_main.info('Rejected subs of client "{}": {!s}'.format(data_.get('name'), e))
+            return
     if data_.get('command'):
         if data_['command'] == 'register' and data_.get('name') and data_.get('mode') in ['head', 'irreversible']:
             if data_['name'] in client_modes:
-                myself.sendto(pickle.dumps({'info': 'error', 'data': 'name already used'}), address_)
+                transport.sendto(codec_.dumps({'info': 'error', 'data': 'name already used'}), address_)
                 log_main.info('Registration failed since name is already in use. ({})'.format(data_['name']))
                 return
+            try:
+                parse_fields(data_.get('fields'))
+            except ValueError as e:
+                transport.sendto(codec_.dumps({'info': 'error', 'data': str(e)}), address_)
+                log_main.info('Registration of "{}" failed: {!s}'.format(data_['name'], e))
+                return
+            if 'start_block' in data_ and not valid_backfill(data_):
+                transport.sendto(codec_.dumps({'info': 'error', 'data': 'invalid backfill range or transport'}),
+                                 address_)
+                log_main.info('Registration of "{}" failed, invalid backfill.'.format(data_['name']))
+                return
+            if data_.get('transport') == 'shm' and data_['mode'] not in rings:
+                transport.sendto(codec_.dumps({'info': 'error', 'data': 'shm transport not provided'}), address_)
+                log_main.info('Registration failed since shm transport is not enabled.')
+                return
+            if data_.get('transport') == 'multicast' and mc_socket is None:
+                transport.sendto(codec_.dumps({'info': 'error', 'data': 'multicast transport not provided'}),
+                                 address_)
+                log_main.info('Registration failed since multicast is not enabled.')
+                return
             if data_['mode'] == 'head' and config.getboolean('PROXY_SETTINGS', 'enable_head',
                                                              fallback=True):
-                clients_head[data_['name']] = [address_, [], standard_ttl]
+                clients_head[data_['name']] = [address_, [], time.monotonic() + standard_ttl,
+                                               client_options(data_, codec_)]
                 log_main.info('Registration to head mode with name "{}" successful.'.format(data_['name']))
-                if not [True for x in threading.enumerate() if x.name == 'head_thread']:
-                    threading.Thread(target=stream_head, name='head_thread').start()
+                start_upstream()
             elif data_['mode'] == 'irreversible' and config.getboolean('PROXY_SETTINGS', 'enable_irreversible',
                                                                        fallback=True):
-                clients_irreversible[data_['name']] = [address_, [], standard_ttl]
+                clients_irreversible[data_['name']] = [address_, [], time.monotonic() + standard_ttl,
+                                                       client_options(data_, codec_)]
                 log_main.info('Registration to irreversible mode with name {} successful.'.format(data_['name']))
-                if not [True for x in threading.enumerate() if x.name == 'irreversible_thread']:
-                    threading.Thread(target=stream_irreversible, name='irreversible_thread').start()
+                start_upstream()
             else:
-                myself.sendto(pickle.dumps({'info': 'error', 'data': 'mode not provided on the server'}), address_)
+                transport.sendto(codec_.dumps({'info': 'error', 'data': 'mode not provided on the server'}), address_)
                 log_main.info('Registration failed since mode "{}" is not provided on server.'.format(data_['mode']))
                 return
             client_modes[data_['name']] = data_['mode']
+            arm(data_['name'], time.monotonic() + standard_ttl)
+            if data_.get('transport') == 'shm':  # only once registered, the subs of these clients are not indexed
+                shm_clients.add(data_['name'])
+                transport.sendto(codec_.dumps({'info': 'shm_ring', 'name': data_['name'], 'codec': ring_codec.name,
+                                               'data': rings[data_['mode']].path}), address_)
+            elif data_.get('transport') == 'multicast':
+                mc_clients.add(data_['name'])
+                transport.sendto(codec_.dumps({'info': 'multicast_groups', 'name': data_['name'],
+                                               'codec': ring_codec.name,
+                                               'data': {'groups': group_addresses(multicast_group, data_['mode'],
+                                                                                  multicast_groups),
+                                                        'port': multicast_port}}), address_)
+            if data_.get('blocks'):
+                block_clients.add(data_['name'])
+            if data_.get('sequenced'):
+                sequences[data_['name']] = [0, OrderedDict()]
+            if isinstance(data_.get('from_block'), int) and 'start_block' not in data_ and store is not None \
+                    and data_.get('transport', 'udp') == 'udp' and store.has(data_['from_block']):
+                recent = recent_head if data_['mode'] == 'head' else recent_irreversible
+                if recent.first_block_num() is None or recent.first_block_num() > data_['from_block']:
+                    data_['start_block'] = data_['from_block']  # resumes from the store instead of the buffer
+            if isinstance(data_.get('start_block'), int):
+                backfilling[data_['name']] = asyncio.get_running_loop().create_task(
+                    backfill(data_['name'], data_['start_block'], data_.get('end_block')))
+            elif isinstance(data_.get('from_block'), int):  # indexed once the replay caught up
+                backfilling[data_['name']] = asyncio.get_running_loop().create_task(
+                    replay_recent(data_['name'], data_['from_block']))
+            if data_.get('subs'):
+                execute_cmd({'command': 'set_subs', 'name': data_['name'], 'subs': data_['subs']}, address_, codec_)
 
         elif data_['command'] == 'unregister' and data_.get('name') in client_modes:
-            if client_modes[data_['name']] == 'head':
-                myself.sendto(pickle.dumps({'info': 'client_delete', 'name': data_['name']}),
-                              clients_head[data_['name']][0])
-                del clients_head[data_['name']]
-            elif client_modes[data_['name']] == 'irreversible':
-                myself.sendto(pickle.dumps({'info': 'client_delete', 'name': data_['name']}),
-                              clients_irreversible[data_['name']][0])
-                del clients_irreversible[data_['name']]
-            del client_modes[data_['name']]
+            delete_client(data_['name'])
             log_main.info('Deleted client "{}" from registration.'.format(data_['name']))
 
         elif data_['command'] == 'refresh' and data_.get('name') in client_modes:
             if client_modes[data_['name']] == 'head':
-                clients_head[data_['name']][2] = standard_ttl
+                clients_head[data_['name']][2] = time.monotonic() + standard_ttl
             elif client_modes[data_['name']] == 'irreversible':
-                clients_irreversible[data_['name']][2] = standard_ttl
+                clients_irreversible[data_['name']][2] = time.monotonic() + standard_ttl
             log_main.debug('Refreshed connection with client "{}".'.format(data_['name']))
 
-        elif data_['command'] == 'set_subs' and data_.get('name') in client_modes and data_.get('subs'):
+        elif data_['command'] == 'set_subs' and data_.get('name') in client_modes \
+                and isinstance(data_.get('subs'), list):  # [] unsubscribes from everything
             if client_modes[data_['name']] == 'head':
-                clients_head[data_['name']][1] = data_['subs']
+                unindex_subs(subs_head, data_['name'], clients_head[data_['name']][1])
+                clients_head[data_['name']][1] = list(data_['subs'])
+                index_subs(subs_head, data_['name'], clients_head[data_['name']][1])
             elif client_modes[data_['name']] == 'irreversible':
-                clients_irreversible[data_['name']][1] = data_['subs']
+                unindex_subs(subs_irreversible, data_['name'], clients_irreversible[data_['name']][1])
+                clients_irreversible[data_['name']][1] = list(data_['subs'])
+                index_subs(subs_irreversible, data_['name'], clients_irreversible[data_['name']][1])
+            subs_changed()
             log_main.info('Set subs of client "{}" to {!s}.'.format(data_['name'], data_['subs']))
 
         elif data_['command'] == 'add_subs' and data_.get('name') in client_modes and data_.get('subs'):
             if client_modes[data_['name']] == 'head':
                 [clients_head[data_['name']][1].append(x) for x in data_['subs']
                  if x not in clients_head[data_['name']][1]]
+                index_subs(subs_head, data_['name'], data_['subs'])
                 log_main.info('Added subs of client "{}" -> {!s}.'.format(data_['name'],
                                                                           clients_head[data_['name']][1]))
             elif client_modes[data_['name']] == 'irreversible':
                 [clients_irreversible[data_['name']][1].append(x) for x in data_['subs']
                  if x not in clients_irreversible[data_['name']][1]]
+                index_subs(subs_irreversible, data_['name'], data_['subs'])
                 log_main.info('Added subs of client "{}" -> {!s}.'.format(data_['name'],
                                                                           clients_irreversible[data_['name']][1]))
+            subs_changed()
 
         elif data_['command'] == 'rem_subs' and data_.get('name') in client_modes and data_.get('subs'):
             if client_modes[data_['name']] == 'head':
                 [clients_head[data_['name']][1].remove(x) for x in data_['subs']
                  if x in clients_head[data_['name']][1]]
+                unindex_subs(subs_head, data_['name'], data_['subs'])
                 log_main.info('Removed subs of client "{}" -> {!s}.'.format(data_['name'],
                                                                             clients_head[data_['name']][1]))
             elif client_modes[data_['name']] == 'irreversible':
                 [clients_irreversible[data_['name']][1].remove(x) for x in data_['subs']
                  if x in clients_irreversible[data_['name']][1]]
+                unindex_subs(subs_irreversible, data_['name'], data_['subs'])
                 log_main.info('Removed subs of client "{}" -> {!s}.'.format(data_['name'],
                                                                             clients_irreversible[data_['name']][1]))
+            subs_changed()
+
+        elif data_['command'] == 'nack' and data_.get('name') in client_modes and data_.get('seqs'):
+            if client_modes[data_['name']] == 'head':
+                retransmit(data_['name'], clients_head[data_['name']], data_['seqs'], data_.get('group'))
+            else:
+                retransmit(data_['name'], clients_irreversible[data_['name']], data_['seqs'], data_.get('group'))
 
         elif data_['command'] == 'info' and data_.get('name') in client_modes:
             if client_modes[data_['name']] == 'head':
-                myself.sendto(pickle.dumps(
-                    {'name': data_['name'], 'info': 'client_info', 'data': clients_head[data_['name']]}),
-                    clients_head[data_['name']][0])
+                client = clients_head[data_['name']]
             else:
-                myself.sendto(pickle.dumps(
-                    {'name': data_['name'], 'info': 'client_info', 'data': clients_irreversible[data_['name']]}),
-                    clients_irreversible[data_['name']][0])
+                client = clients_irreversible[data_['name']]
+            send(client_codec(client).dumps({'name': data_['name'], 'info': 'client_info', 'data': client}), client[0],
+                 client_codec(client))
             log_main.info('Sent info of client "{}".'.format(data_['name']))
 
         elif data_['command'] == 'stop':
-            [myself.sendto(pickle.dumps({'info': 'stop', 'name': client}), clients_head[client][0])
-             for client in clients_head]
-            [myself.sendto(pickle.dumps({'info': 'stop', 'name': client}), clients_irreversible[client][0])
-             for client in clients_irreversible]
+            [transport.sendto(client_codec(client).dumps({'info': 'stop', 'name': client_name}), client[0])
+             for client_name, client in clients_head.items()]
+            [transport.sendto(client_codec(client).dumps({'info': 'stop', 'name': client_name}), client[0])
+             for client_name, client in clients_irreversible.items()]
             global running
             running = False
+            stopped.set()
+
+        elif data_['command'] == 'stats':
+            send(codec_.dumps({'info': 'stats', 'data': metrics.snapshot()}), address_, codec_)
+            log_main.debug('Sent stats.')
 
         elif data_['command'] == 'ping':
             if data_.get('name') in client_modes:
                 if client_modes[data_['name']] == 'head':
-                    myself.sendto(pickle.dumps({'info': 'ping_answer', 'name': data_['name']}),
-                                  clients_head[data_['name']][0])
+                    client = clients_head[data_['name']]
+                    transport.sendto(client_codec(client).dumps({'info': 'ping_answer', 'name': data_['name']}),
+                                     client[0])
                 else:
-                    myself.sendto(pickle.dumps({'info': 'ping_answer', 'name': data_['name']}),
-                                  clients_irreversible[data_['name']][0])
+                    client = clients_irreversible[data_['name']]
+                    transport.sendto(client_codec(client).dumps({'info': 'ping_answer', 'name': data_['name']}),
+                                     client[0])
                 log_main.info('Sent pong to client "{}".'.format(data_['name']))
             else:
-                myself.sendto(pickle.dumps({'info': 'ping_answer'}), address_)
+                transport.sendto(codec_.dumps({'info': 'ping_answer'}), address_)
                 log_main.info('Sent pong to unknown client.')
 
         elif data_['command'] == 'is_registered':
             if data_.get('name') in client_modes:
-                myself.sendto(pickle.dumps({'info': 'registered', 'data': True}), address_)
+                transport.sendto(codec_.dumps({'info': 'registered', 'data': True}), address_)
             else:
-                myself.sendto(pickle.dumps({'info': 'registered', 'data': False}), address_)
+                transport.sendto(codec_.dumps({'info': 'registered', 'data': False}), address_)
             log_main.info('Sent registration answer to unknown client.')
 
         else:
@@ -239,28 +1309,206 @@ def execute_cmd(data_, address_):
         log_main.error('need command')
 
 
-myself = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+class ProxyProtocol(asyncio.DatagramProtocol):
+    @staticmethod
+    def decode(data_list, address):
+        """The codec and the command dicts of a datagram, None if it is dropped."""
+        codec_ = codec_of(data_list)
+        if codec_.name == 'pickle' and not allow_pickle:
+            log_main.warning('Dropped pickled message from {!s}, allow_pickle is off.'.format(address))
+            return None
+        try:
+            data_list = codec_.loads(data_list)
+        except Exception as e:
+            log_main.warning('Dropped undecodable message from {!s}: {!r}'.format(address, e))
+            return None
+        log_main.log(5, data_list)
+        if isinstance(data_list, dict):
+            data_list = [data_list]
+        return codec_, [data for data in data_list if isinstance(data, dict)] if isinstance(data_list, list) else []
 
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-server_socket.bind(('localhost', config.get('PROXY_SETTINGS', 'port', fallback=8080)))
+    def datagram_received(self, data_list, address):
+        decoded = self.decode(data_list, address)
+        if decoded is not None:
+            for data in decoded[1]:
+                execute_cmd(data, address, decoded[0])
 
-running = True
-while running:
-    log_main.log(5, 'client_modes: ' + str(client_modes))
-    log_main.log(5, 'clients_head: ' + str(clients_head))
-    log_main.log(5, 'clients_irre: ' + str(clients_irreversible))
-    log_main.log(5, 'enumerate: ' + str(threading.enumerate()))
-
-    data_list, address = server_socket.recvfrom(512)
-    data_list = pickle.loads(data_list)
-    log_main.log(5, data_list)
-    if isinstance(data_list, list):
-        for data in data_list:
-            if isinstance(data, dict):
-                execute_cmd(data, address)
-    elif isinstance(data_list, dict):
-        execute_cmd(data_list, address)
-
-[x.join() for x in threading.enumerate() if x is not threading.current_thread()]
-
-log_main.info('server shut down')
+    def error_received(self, exc):
+        metrics.inc('proxy_send_errors_total')
+        log_main.warning('Socket error: {!s}'.format(exc))
+
+    def pause_writing(self):
+        writable.clear()
+
+    def resume_writing(self):
+        writable.set()
+
+
+class ShardRouter(ProxyProtocol):
+    """Server socket of the parent of workers: forwards the commands of each client to its worker."""
+
+    def datagram_received(self, data_list, address):
+        decoded = self.decode(data_list, address)
+        if decoded is None:
+            return
+        codec_, commands = decoded
+        names = [data['name'] for data in commands if isinstance(data.get('name'), str)]
+        if any(data.get('command') == 'stop' for data in commands):
+            for writer in shard_writers:  # every worker tells its clients
+                writer.write(frame(('datagram', address, data_list)))
+            for data in commands:
+                execute_cmd(data, address, codec_)
+        elif any(data.get('command') == 'stats' for data in commands):
+            asyncio.get_running_loop().create_task(answer_stats(address, codec_))
+        elif names:
+            shard_writers[worker_of(names[0], len(shard_writers))].write(frame(('datagram', address, data_list)))
+            if any(data.get('command') == 'register' for data in commands):
+                start_upstream()  # like a single proxy, streams from the first client on
+        else:
+            for data in commands:
+                execute_cmd(data, address, codec_)
+
+
+async def main():
+    global transport, stopped, queued, writable, sender_task, expiry_task, store, http_server, snapshot_task, \
+        handover_task
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    queued = asyncio.Event()
+    writable = asyncio.Event()
+    writable.set()
+    port = config.getint('PROXY_SETTINGS', 'port', fallback=8080)
+    server_socket, state = await loop.run_in_executor(None, take_over)
+    if block_store_dir:
+        store = BlockStore(block_store_dir, block_store_segment, block_store_bytes)
+    if shm_transport:
+        for mode in ['head', 'irreversible']:
+            rings[mode] = RingWriter(default_path(port, mode, config.get('PROXY_SETTINGS', 'shm_dir', fallback=None)),
+                                     shm_size)
+    if server_socket is not None:
+        transport, _ = await loop.create_datagram_endpoint(ProxyProtocol, sock=server_socket)
+    else:
+        transport, _ = await loop.create_datagram_endpoint(ProxyProtocol, local_addr=('localhost', port))
+        state = read_state()
+    if state is not None:
+        restore_registry(state)
+    sender_task = loop.create_task(drain_queues())
+    expiry_task = loop.create_task(expire_clients())
+    http_server = await serve_http(metrics, metrics_port) if metrics_port else None
+    if state_file:
+        snapshot_task = loop.create_task(snapshot_registry())
+    if handover_socket:
+        handover_task = loop.create_task(wait_for_handover())
+    for signal_number in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(signal_number, stopped.set)
+    await stopped.wait()
+    if handed_over:
+        log_main.info('server handed over')
+        return
+    release()
+    if state_file and running:  # stopped by a signal, the clients stay registered for the next process
+        write_state()
+    elif state_file and os.path.exists(state_file):
+        os.remove(state_file)  # the stop command told the clients to stop
+    transport.close()
+    log_main.info('server shut down')
+
+
+async def shard_main(server_socket, channels):
+    """Parent of the workers: streams the blocks once for all of them and routes the commands of the clients."""
+    global transport, stopped, queued, writable, store, http_server
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    queued = asyncio.Event()
+    writable = asyncio.Event()
+    writable.set()
+    if block_store_dir:
+        store = BlockStore(block_store_dir, block_store_segment, block_store_bytes)
+    transport, _ = await loop.create_datagram_endpoint(ShardRouter, sock=server_socket)
+    for number, channel in enumerate(channels):
+        reader, writer = await asyncio.open_unix_connection(sock=channel)
+        shard_writers.append(writer)
+        shard_tasks.append(loop.create_task(read_worker(number, reader)))
+    http_server = await serve_http(metrics, metrics_port) if metrics_port else None
+    for signal_number in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(signal_number, stopped.set)
+    log_main.info('Serving with {} workers.'.format(len(channels)))
+    await stopped.wait()
+    release()
+    for task in shard_tasks:
+        task.cancel()
+    for writer in shard_writers:
+        writer.write(frame(('exit',)))
+        writer.close()
+    transport.close()
+    log_main.info('server shut down')
+
+
+async def worker_main(channel, server_socket):
+    """A worker: serves its share of the clients with the blocks of the parent, sending from the server socket."""
+    global transport, stopped, queued, writable, sender_task, expiry_task, block_source
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    queued = asyncio.Event()
+    writable = asyncio.Event()
+    writable.set()
+    reader, writer = await asyncio.open_unix_connection(sock=channel)
+    block_source = ParentBlockSource(loop, writer)
+    transport, protocol = await loop.create_datagram_endpoint(ProxyProtocol, sock=server_socket)
+    transport.pause_reading()  # the parent reads the server socket and forwards the datagrams of our clients
+    sender_task = loop.create_task(drain_queues())
+    expiry_task = loop.create_task(expire_clients())
+    channel_task = loop.create_task(read_parent(reader, writer, protocol))
+    loop.add_signal_handler(signal.SIGTERM, stopped.set)
+    loop.add_signal_handler(signal.SIGINT, lambda: None)  # the parent stops the workers
+    log_main.info('Worker {} started.'.format(worker_number))
+    await stopped.wait()
+    channel_task.cancel()
+    release()
+    writer.close()
+    transport.close()
+    log_main.info('Worker {} shut down.'.format(worker_number))
+
+
+def serve_shards():
+    """Forks shard_workers workers sharing the server socket, each owning the clients whose names hash to it."""
+    global worker_number, mc_socket
+    if shm_transport or mc_socket is not None or state_file or handover_socket:
+        log_main.warning('The shm and multicast transports, state_file and handover_socket are not available with '
+                         'workers.')
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_socket.bind(('localhost', config.getint('PROXY_SETTINGS', 'port', fallback=8080)))
+    server_socket.setblocking(False)
+    if mc_socket is not None:
+        mc_socket.close()
+        mc_socket = None
+    channels, pids = [], []
+    for number in range(shard_workers):
+        parent_end, worker_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                parent_end.close()
+                for channel in channels:
+                    channel.close()
+                worker_number = number
+                asyncio.run(worker_main(worker_end, server_socket))
+                status = 0
+            except Exception:
+                log_main.exception('Worker {} failed.'.format(number))
+            finally:
+                os._exit(status)
+        worker_end.close()
+        channels.append(parent_end)
+        pids.append(pid)
+    asyncio.run(shard_main(server_socket, channels))
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    if shard_workers:
+        serve_shards()
+    else:
+        asyncio.run(main())
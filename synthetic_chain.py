@@ -0,0 +1,128 @@
+from block_source import ops_of_block
+
+from datetime import datetime, timezone
+import hashlib
+import logging
+import random
+import time
+
+log = logging.getLogger('StreamProxy_source')
+
+# Synthetic STEEM blocks for tests and benchmarks. Each block only depends on its number and the settings of the
+# generator, so a benchmark can compute which ops a client should have received.
+DEFAULT_MIX = {'vote': 50, 'comment': 15, 'transfer': 15, 'custom_json': 20}
+ACCOUNTS = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank']
+
+
+def parse_mix(text: str):
+    """Op mix like 'vote:50,comment:20' as a dict of op type: weight."""
+    mix = {}
+    for part in text.split(','):
+        if part.strip():
+            op_type, _, weight = part.partition(':')
+            mix[op_type.strip()] = float(weight or 1)
+    return mix
+
+
+def block_id(block_num: int):
+    return '{:08x}'.format(block_num) + hashlib.sha1(str(block_num).encode()).hexdigest()[:32]
+
+
+class ChainGenerator:
+    """Raw blocks as a node returns them from condenser_api.get_block.
+
+    ``ops`` ops per block of the types of ``mix``; comment bodies are exponentially distributed around ``body_size``
+    bytes, a share ``oversized`` of them has ``oversized_size`` bytes and needs several datagrams.
+    """
+
+    def __init__(self, ops: int = 20, mix: dict = None, body_size: int = 500, oversized: float = 0,
+                 oversized_size: int = 100000, seed: int = 0):
+        self.ops = ops
+        self.types = list((mix or DEFAULT_MIX).keys())
+        self.weights = list((mix or DEFAULT_MIX).values())
+        self.body_size = body_size
+        self.oversized = oversized
+        self.oversized_size = oversized_size
+        self.seed = seed
+
+    def _op(self, rng: random.Random, block_num: int, trx_num: int):
+        op_type = rng.choices(self.types, self.weights)[0]
+        if op_type == 'vote':
+            return ['vote', {'voter': rng.choice(ACCOUNTS), 'author': rng.choice(ACCOUNTS),
+                             'permlink': 'post-{}'.format(rng.randrange(1000)), 'weight': 10000}]
+        if op_type == 'comment':
+            if rng.random() < self.oversized:
+                size = self.oversized_size
+            else:
+                size = int(rng.expovariate(1 / self.body_size)) if self.body_size else 0
+            return ['comment', {'parent_author': '', 'parent_permlink': 'steem', 'author': rng.choice(ACCOUNTS),
+                                'permlink': 'post-{}-{}'.format(block_num, trx_num), 'title': 'title',
+                                'body': 'x' * size, 'json_metadata': '{}'}]
+        if op_type == 'transfer':
+            return ['transfer', {'from': rng.choice(ACCOUNTS), 'to': rng.choice(ACCOUNTS), 'amount': '1.000 STEEM',
+                                 'memo': ''}]
+        if op_type == 'custom_json':
+            return ['custom_json', {'required_auths': [], 'required_posting_auths': [rng.choice(ACCOUNTS)],
+                                    'id': rng.choice(['follow', 'reblog']), 'json': '[]'}]
+        return [op_type, {'account': rng.choice(ACCOUNTS)}]
+
+    def raw_block(self, block_num: int, timestamp: float):
+        rng = random.Random(self.seed * 1000003 + block_num)
+        operations = [self._op(rng, block_num, trx_num) for trx_num in range(self.ops)]
+        return {'previous': block_id(block_num - 1),
+                'block_id': block_id(block_num),
+                'timestamp': datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S'),
+                'witness': 'synthetic',
+                'transactions': [{'operations': [operation]} for operation in operations],
+                'transaction_ids': [hashlib.sha1('{}-{}'.format(block_num, trx_num).encode()).hexdigest()
+                                    for trx_num in range(len(operations))]}
+
+    def ops_of(self, block_num: int):
+        """The ops of a block like a block source delivers them, for counting the expected ones."""
+        return ops_of_block(self.raw_block(block_num, 0), block_num)
+
+
+class SyntheticBlockSource:
+    """Generates a block every ``interval`` seconds from ``start_block`` on, ``count`` blocks (0 for no end).
+
+    Every op carries ``generated``, the unix time its block was generated, to measure the delivery latency.
+    """
+
+    def __init__(self, generator: ChainGenerator, interval: float = 3, start_block: int = 1, count: int = 0,
+                 irreversible_lag: int = 20):
+        self.generator = generator
+        self.interval = interval
+        self.start_block = start_block
+        self.count = count
+        self.irreversible_lag = irreversible_lag
+        self.head = start_block - 1
+
+    def _convert(self, block_num: int):
+        now = time.time()
+        ops = ops_of_block(self.generator.raw_block(block_num, now), block_num)
+        for tx in ops:
+            tx['generated'] = now
+        return {'block_num': block_num,
+                'block_id': block_id(block_num),
+                'previous': block_id(block_num - 1),
+                'timestamp': ops[0]['timestamp'] if ops else None,
+                'irreversible_block_num': max(self.start_block, self.head - self.irreversible_lag),
+                'ops': ops}
+
+    def blocks(self):
+        """Continues after the last generated block, the proxy asks again after it had no clients for a while."""
+        first = block_num = self.head + 1
+        log.info('Generating a block every {}s from block {} on.'.format(self.interval, first))
+        start = time.monotonic()
+        while not self.count or block_num < self.start_block + self.count:
+            delay = start + (block_num - first) * self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.head = block_num
+            yield self._convert(block_num)
+            block_num += 1
+
+    def get_block(self, block_num: int):
+        if not self.start_block <= block_num <= self.head:
+            return None
+        return self._convert(block_num)